@@ -3,6 +3,7 @@ import scipy.integrate as spi
 import numpy as np
 import scipy.special as sse
 import locale
+import functools
 locale.setlocale(locale.LC_ALL, 'en_US')
 
 # constants
@@ -11,7 +12,48 @@ e = physical_constants['electron volt'][0]
 m_pi, m_k = 139.57018, 493.677 # TODO: uncert 0.00035, 0.013 respectively
 
 def convoluted_exponential(t, A, tau, s):
-	return A * 1/(2*tau) * np.exp(1/tau * (s**2/(2*tau) - t)) * (1- sse.erf((s**2 / tau - t)/(2**0.5 * s)))
+	return A * np.exp(convoluted_exponential_log(t, tau, s))
+
+# log of convoluted_exponential with A=1
+# - 1-erf((s^2/tau - t)/(sqrt(2) s)) = 2 ndtr(t/s - s/tau), so the exp and erf factors that over and underflow
+#   in the tails (negative t, small tau) are added as logs, with log_ndtr, and never formed on their own
+# - dtype=np.float32 evaluates it in single precision, for big batches
+def convoluted_exponential_log(t, tau, s, dtype=np.float64):
+	t, tau, s = np.asarray(t, dtype=dtype), np.asarray(tau, dtype=dtype), np.asarray(s, dtype=dtype)
+	return -np.log(tau) + s**2/(2*tau**2) - t/tau + sse.log_ndtr(t/s - s/tau)
+
+# convoluted_exponential (with A=1) is normalised over all t, this is its integral up to t
+def convoluted_exponential_cdf(t, tau, s):
+	return sse.ndtr(t/s) - np.exp(s**2/(2*tau**2) - t/tau + sse.log_ndtr(t/s - s/tau))
+
+def std_normal(z):
+	return np.exp(-z**2/2)/np.sqrt(2*np.pi)
+
+# std_normal(z)/ndtr(z), without the 0/0 for very negative z
+def normal_hazard(z):
+	return np.exp(-z**2/2 - np.log(np.sqrt(2*np.pi)) - sse.log_ndtr(z))
+
+# first and second derivatives of log(convoluted_exponential) wrt tau, worked in lam = 1/tau
+def convoluted_exponential_dtau(t, tau, s):
+	lam = 1/tau
+	z = t/s - lam*s
+	r = normal_hazard(z)
+	d1_lam = 1/lam + lam*s**2 - t - s*r
+	d2_lam = -1/lam**2 + s**2 - s**2*(z*r + r**2)
+	return -d1_lam/tau**2, d2_lam/tau**4 + 2*d1_lam/tau**3
+
+# integral of convoluted_exponential (with A=1) over range, and its first and second derivatives wrt tau
+# - tau and s can be arrays, e.g. a resolution width for every event
+def convoluted_exponential_integral(range, tau, s):
+	lam = 1/tau
+	x = np.array(range, dtype=float).reshape((2,) + (1,)*np.ndim(lam*s))
+	G = np.exp(lam**2*s**2/2 - lam*x + sse.log_ndtr(x/s - lam*s))
+	dG = (lam*s**2 - x)*G - s*std_normal(x/s)
+	d2G = s**2*G + (lam*s**2 - x)*dG
+	# I = F(up) - F(low), and only the -G part of F depends on tau
+	I = convoluted_exponential_cdf(x[1], tau, s) - convoluted_exponential_cdf(x[0], tau, s)
+	dI_lam, d2I_lam = -(dG[1] - dG[0]), -(d2G[1] - d2G[0])
+	return I, -dI_lam/tau**2, d2I_lam/tau**4 + 2*dI_lam/tau**3
 
 def gaussian(t, A, s, m):
 	return A * np.exp(-(t-m)**2/(2*s**2))
@@ -21,8 +63,21 @@ def double_gaussian(t, A, m, s1, s2, f):
 		(1-f) * np.exp(-(t-m)**2/(2*s2**2)))
 
 
+# closed forms of the integral of pdf(t, *args) over range, for the pdfs that have one
+analytic_integrals = {
+	convoluted_exponential: lambda range, A, tau, s: A*convoluted_exponential_integral(range, tau, s)[0],
+}
+
+# 1/integral of pdf over range, memoized since fits and scans ask for the same (tau, s, range) many times
+# - uses the closed form where there is one, quad for any other pdf, or if the closed form isn't finite and positive
 def normalisation_const(pdf, range, args):
-	i = spi.quad(pdf, range[0], range[1], args=args)[0]
+	return cached_normalisation_const(pdf, tuple(range), tuple(args))
+
+@functools.lru_cache(maxsize=4096)
+def cached_normalisation_const(pdf, range, args):
+	i = analytic_integrals[pdf](range, *args) if pdf in analytic_integrals else np.nan
+	if not (np.isfinite(i) and i > 0):
+		i = spi.quad(pdf, range[0], range[1], args=args)[0]
 	return 1/i
 
 def background_fit(dm, bg_A, bg_p, bg_m):
@@ -35,6 +90,20 @@ def combined_fit(dm, bg_A, bg_p, bg_m, sig_A, sig_centre, sig_w1, sig_w2, f):
 	return signal_fit(dm, sig_A, sig_centre, sig_w1, sig_w2, f) + background_fit(dm, bg_A, bg_p, bg_m)
 
 
+# fits combined_fit to a mass difference histogram, masses are the bin centroids
+# - empty bins are left out, they have no error and their centre can be below the kinematic limit
+def fit_massDiff(masses, hist, bg_ratio=0.15, verbose=True):
+	initial = [max(hist)*0.2666666667*bg_ratio, 0.25, m_pi, max(hist)*1.2, 145.5, .1, 1., .9]
+
+	filled = hist > 0
+	masses, hist = masses[filled], hist[filled]
+	# https://suchideas.com/articles/maths/applied/histogram-errors/
+	errors = np.sqrt(hist)
+	po, po_cov = spo.curve_fit(combined_fit, masses, hist, initial, sigma=errors, bounds=([0, .25, 139, 0, 0, 0, 0, 0], [np.inf, .33, 140, np.inf, np.inf, 1, 5, np.inf]))
+	if verbose:
+		print('po-fit', po)
+	return po
+
 
 def get_sig_range(po, width):
 	bg_A, bg_p, bg_m, sig_A, sig_centre, sig_w1, sig_w2, f = po
@@ -43,26 +112,56 @@ def get_sig_range(po, width):
 	return range_low, range_up
 
 
-def calculate_weight(po, filtered, range_low, range_up):
-	sig_centre, sig_w = po[3], po[4]
-	bg_kinematic_limit, max_dm = po[2], 165
-	na = spi.quad(background_fit, range_low, range_up, args=(po[0], po[1], po[2]))[0]
-	nb = spi.quad(background_fit, bg_kinematic_limit, max_dm, args=(po[0], po[1], po[2]))[0]-na
-	wb = - na/nb
-	print("Na", na)
-	print("Nb", nb)
-	print("wb", wb)
-	return wb
+# integral of background_fit from a to b, it is 0 below the kinematic limit bg_m
+def background_integral(a, b, bg_A, bg_p, bg_m):
+	a, b = np.maximum(a, bg_m), np.maximum(b, bg_m)
+	return bg_A/(bg_p+1) * ((b-bg_m)**(bg_p+1) - (a-bg_m)**(bg_p+1))
+
+# integral of signal_fit from a to b, each gaussian is s sqrt(pi/2) (erf(..b..) - erf(..a..))
+def signal_integral(a, b, sig_A, sig_centre, sig_w1, sig_w2, f):
+	def gaussian_integral(s):
+		return s*np.sqrt(np.pi/2) * (sse.erf((b-sig_centre)/(np.sqrt(2)*s)) - sse.erf((a-sig_centre)/(np.sqrt(2)*s)))
+	return sig_A * (f*gaussian_integral(sig_w1) + (1-f)*gaussian_integral(sig_w2))
+
+
+# Sideband subtraction for a mass difference fit po, with the signal range width widths either side of the peak.
+# - Na is the background in the signal range, Nb in the sidebands up to max_dm, and the sideband events are
+#   weighted by wb = -Na/Nb so they take the background out of the signal range
+# - the integrals are worked out once, in closed form, so scans and toys can make one for every fit
+class SidebandModel(object):
+	def __init__(self, po, width, max_dm=165):
+		self.po, self.width, self.max_dm = po, width, max_dm
+		self.range_low, self.range_up = get_sig_range(po, width)
+		self.Na = background_integral(self.range_low, self.range_up, *po[:3])
+		self.Nb = background_integral(po[2], max_dm, *po[:3]) - self.Na
+		self.wb = -self.Na/self.Nb
+		self.signal = signal_integral(self.range_low, self.range_up, *po[3:])
+
+	def in_signal(self, mass_diffs):
+		return (self.range_low <= mass_diffs) & (mass_diffs <= self.range_up)
 
+	# 1 for the events in the signal range, wb for those in the sidebands
+	def weights(self, mass_diffs):
+		return np.where(self.in_signal(mass_diffs), 1, self.wb)
 
-def estimate_background(po, filtered, bin_width, width):
-	range_low, range_up = get_sig_range(po, width)
-	bg_integral = spi.quad(background_fit, range_low, range_up, args=(po[0], po[1], po[2]))[0]/bin_width
-	sig_integral = spi.quad(signal_fit, range_low, range_up, args=(po[3], po[4], po[5], po[6], po[7]))[0]/bin_width
+	# signal and background in the signal range, in events when po was fitted to a histogram with bins of bin_width
+	def yields(self, bin_width):
+		return self.signal/bin_width, self.Na/bin_width
+
+	def print_weights(self):
+		print("Na", self.Na)
+		print("Nb", self.Nb)
+		print("wb", self.wb)
+
+
+# num_events is only printed
+def estimate_background(po, num_events, bin_width, width, verbose=True):
+	sig_integral, bg_integral = SidebandModel(po, width).yields(bin_width)
 
 	bg_fraction = bg_integral/(sig_integral + bg_integral)
 
-	print("BACKGROUND EST", bg_integral, len(filtered), str(bg_fraction*100) + "%")
+	if verbose:
+		print("BACKGROUND EST", bg_integral, num_events, str(bg_fraction*100) + "%")
 	return bg_integral, sig_integral, bg_fraction
 
 
@@ -83,3 +182,22 @@ def add_val(name, val, round_to=1):
 
 def add_int(name, d):
 	write_list.append(Record(name, locale.format("%d", d, grouping=True)))
+
+
+# fit results and the histograms they are fitted to, which the plot stage draws, name -> {key: array}
+result_list = {}
+
+def add_result(name, **arrays):
+	result_list[name] = arrays
+
+# all results in one npz, the keys of each prefixed by its name
+def save_results(path='fit-results.npz'):
+	np.savez(path, **{'%s.%s' % (name, key): np.asarray(a) for name, d in result_list.items() for key, a in d.items()})
+
+def load_results(path='fit-results.npz'):
+	results = {}
+	with np.load(path) as f:
+		for k in f.files:
+			name, key = k.rsplit('.', 1)
+			results.setdefault(name, {})[key] = f[k]
+	return results
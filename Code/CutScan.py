@@ -0,0 +1,88 @@
+import time
+import itertools
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from Background import *
+from Histogram import Histogram
+from Selection import Cut, cut_mask
+from Shared import SharedArrays, worker, init_worker
+
+
+# Grid search over cut thresholds for the best signal significance, in place of editing Cuts.py and re-running.
+# - each axis is a list of alternative Cuts on one column, see scan_axis
+# - the mask of every threshold is computed once and kept packed, a combination is the bitwise AND of one
+#   mask from each axis, so no column is evaluated more than once whatever the size of the grid
+# - every combination refits the mass difference histogram of the events it keeps and takes the signal and
+#   background yields in the signal range from SidebandModel, the fits run across a process pool
+
+# fom, signal, background and num_events are arrays with one axis per scan axis
+ScanResult = namedtuple('ScanResult', ['axes', 'fom', 'signal', 'background', 'num_events', 'seconds'])
+
+# fixed binning of the mass difference fits, the same for every combination
+dm_range, dm_bins = (139, 165), 100
+
+
+# the cuts on column with every combination of the lower and upper limits, e.g. scan_axis('pD0_t', lows=range(0, 5000, 250))
+def scan_axis(column, lows=(None,), highs=(None,), veto=False):
+	return [Cut(column, low, high, veto) for low, high in itertools.product(lows, highs)]
+
+# S/sqrt(S+B)
+def significance(signal, background):
+	return signal/np.sqrt(signal + background)
+
+
+# the signal and background yields and number of events kept by one combination, one index into each axis
+# - nan yields where there are too few events, or the mass difference fit fails
+def run_combination(index):
+	scan, arrays = worker['scan'], worker['arrays']
+	bits = arrays['axis0'][index[0]]
+	for i, j in enumerate(index[1:], 1):
+		bits = bits & arrays['axis%d' % i][j]
+	mask = np.unpackbits(bits, count=len(arrays['dm'])).astype(bool)
+	num_events = np.count_nonzero(mask)
+	if num_events < scan['min_events']:
+		return np.nan, np.nan, num_events
+
+	hist = Histogram(dm_bins, dm_range)
+	hist.fill(arrays['dm'][mask])
+	try:
+		po = fit_massDiff(hist.centroids, hist.counts, scan['bg_ratio'], verbose=False)
+	except (RuntimeError, ValueError):
+		return np.nan, np.nan, num_events
+	sig_integral, bg_integral = SidebandModel(po, scan['width']).yields(hist.bin_width)
+	return sig_integral, bg_integral, num_events
+
+
+# fom(signal, background) for every combination of one cut from each of axes, on top of the events given
+# - width is the signal range in widths as for get_sig_range, bg_ratio the initial background level of the fits
+def scan_cuts(events, axes, fom=significance, width=3., bg_ratio=.15, min_events=200, workers=None):
+	start = time.time()
+	# one packed mask per threshold
+	arrays = {'dm': events.massDiff_d0dstar}
+	for i, axis in enumerate(axes):
+		arrays['axis%d' % i] = np.stack([np.packbits(cut_mask(events, cut)) for cut in axis])
+
+	shape = tuple(len(axis) for axis in axes)
+	combinations = list(itertools.product(*[range(n) for n in shape]))
+	scan = {'width': width, 'bg_ratio': bg_ratio, 'min_events': min_events}
+
+	with SharedArrays(arrays) as shared:
+		with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(shared.spec, {'scan': scan})) as pool:
+			results = np.array(list(pool.map(run_combination, combinations, chunksize=max(1, len(combinations) // 256))))
+
+	signal, background, num_events = [r.reshape(shape) for r in results.T]
+	return ScanResult(axes, fom(signal, background), signal, background, num_events.astype(int), time.time() - start)
+
+
+# the cuts of the combination with the highest figure of merit
+def best_cuts(res: ScanResult):
+	index = np.unravel_index(np.nanargmax(res.fom), res.fom.shape)
+	return [axis[i] for axis, i in zip(res.axes, index)], index
+
+def print_scan(res: ScanResult):
+	cuts, index = best_cuts(res)
+	print('combinations', res.fom.size, 'failed', np.count_nonzero(np.isnan(res.fom)), 'seconds', res.seconds)
+	print('best fom', res.fom[index], 'signal', res.signal[index], 'background', res.background[index], 'events', res.num_events[index])
+	for c in cuts:
+		print('%s%s <= %s <= %s' % ('veto ' if c.veto else '', c.low, c.column, c.high))
@@ -1,88 +1,100 @@
 from Lifetime import *
-from matplotlib.colors import LogNorm
-
-def cut(accepted, rejected, cond):
-	acc, rej = [], list(rejected)
-	for a in accepted:
-		if cond(a):
-			acc.append(a)
-		else:
-			rej.append(a)
-
-	return np.array(acc), np.array(rej)
+from Stream import stream_cuts, mass_window
+from Selection import Cut, Selection
+from CutScan import scan_cuts, scan_axis, print_scan
+from Stages import run_stage
+from Fitting import fit_range, pdf_gaussian_width, mass_time_fit, decay_time_sigmas
+from Resolution import fit_resolution
+from Toys import toy_study, bootstrap_study, print_summary
+
+data_file = 'np.txt' if '--full-set' in sys.argv else 'np-short.txt'
+
+# --no-plot runs the analysis and writes data.txt and fit-results.npz without importing matplotlib,
+# python Plots.py draws the fits from fit-results.npz later
+plot = not '--no-plot' in sys.argv
+if plot:
+	from Plots import *
+
+# the fits are cached in .stage-cache/ and only rerun when their events or settings change
+use_stage_cache = not '--no-stage-cache' in sys.argv
+# --parallel-fit evaluates the lifetime likelihood, and the --fit-2d one, across all the cores
+fit_workers = None if '--parallel-fit' in sys.argv else 1
+
+# bounded memory run of the same cuts and fits, a chunk of events at a time and without plots
+if '--stream' in sys.argv:
+	stream_cuts(cwd+'/'+data_file)
+	write_out()
+	save_results()
+	sys.exit()
+
+# grid search of the cut thresholds on the events in the D0/D* mass window, without plots
+if '--cut-scan' in sys.argv:
+	data = readFile(data_file)
+	data = data[mass_window(data)]
+	res = scan_cuts(data, [
+		scan_axis('pD0_t', lows=np.arange(0, 5001, 500)),
+		scan_axis('pPslow_t', lows=np.arange(0, 401, 100), highs=[2500, None]),
+		scan_axis('d0IP_log', lows=[None, -7, -6, -5], highs=np.arange(-3.5, -1.9, .5)),
+	], bg_ratio=.01)
+	print_scan(res)
+	np.savez('cut-scan.npz', fom=res.fom, signal=res.signal, background=res.background, num_events=res.num_events)
+	sys.exit()
 
 #get data
-data = readFile('np.txt' if '--full-set' in sys.argv else 'np-short.txt')
+data = readFile(data_file)
 # cut on mass diff
 width = 3.
-signal_region, background_sidebands, po_fullset, bin_width = cutEventSet_massDiff(data, width)
+in_signal, po_fullset, bin_width = run_stage('massDiff-fullset', signal_region_mask, data, width, use_cache=use_stage_cache)
+signal_region, background_sidebands = data[in_signal], data[~in_signal]
 filtered = data
-rejected = []
 print(len(data))
-bg_integral, sig_integral, bg_fraction = estimate_background(po_fullset, filtered, bin_width, width)
+bg_integral, sig_integral, bg_fraction = estimate_background(po_fullset, len(filtered), bin_width, width)
 
 add_int('bg_integral_before', bg_integral)
 add_int('sig_integral_before', sig_integral)
 add_val('bg_fraction_before', bg_fraction*100)
 
-fig, ax = newfig()
-md = [d.massDiff_d0dstar for d in data]
-d0 = [mass_toMeV(d.reconstructedD0Mass)/1000 for d in data]
-pl.hist2d(md, d0, bins=150 if is_latex else 200, norm=LogNorm())
-pl.colorbar()
-pl.xlabel(r'$\Delta m$ [MeV$/c^2$]')
-pl.ylabel(r'$m_{D^0}$ [GeV$/c^2$]')
-ax.set_xlim(139, 170)
-ax.set_ylim(1.79, 1.94)
-savefig_image('mass-diff-hist', directory='../report/' if is_latex else '')
-pl.close()
-
-fig, ax = newfig()
-d0 = [mass_toMeV(d.reconstructedD0Mass)/1000 for d in data]
-pl.hist(d0, bins=150 if is_latex else 200)
-pl.xlabel(r'$m_{D^0}$ [GeV$/c^2$]')
-# pl.ylabel(r'$m_{D^0}$ [GeV$/c^2$]')
-ax.set_xlim(1.79, 1.94)
-savefig('mass-d0-hist', directory='../report/' if is_latex else '')
-pl.close()
-
-
-
-# if not '--no-plot' in sys.argv:
+if plot:
+	queue_plot(plot_masses, mass_histograms(data))
+
+
+
+# if plot:
 # 	print('plot')
 #
-# 	massDiff_plot(data, ext_name='-KK', fit=False, methodName='reconstructedD0Mass_kk', range=None)
-# 	massDiff_plot(data, ext_name='-PP', fit=False, methodName='reconstructedD0Mass_pp', range=None)
+# 	massDiff_fit(data, ext_name='-KK', fit=False, methodName='reconstructedD0Mass_kk')
+# 	massDiff_fit(data, ext_name='-PP', fit=False, methodName='reconstructedD0Mass_pp')
 #
 # 	newfig()
-# 	pl.plot([f.massDiff_d0dstar for f in signal_region], [f.pD0_t for f in signal_region], ',g')
-# 	pl.plot([f.massDiff_d0dstar for f in background_sidebands], [f.pD0_t for f in background_sidebands], ',r')
+# 	pl.plot(signal_region.massDiff_d0dstar, signal_region.pD0_t, ',g')
+# 	pl.plot(background_sidebands.massDiff_d0dstar, background_sidebands.pD0_t, ',r')
 # 	savefig('dm-pD0_t-correlation')
 # 	pl.close()
 #
 #
 # 	newfig()
-# 	pl.plot([f.massDiff_d0dstar for f in signal_region], [f.pPslow for f in signal_region], ',g')
-# 	pl.plot([f.massDiff_d0dstar for f in background_sidebands], [f.pPslow for f in background_sidebands], ',r')
+# 	pl.plot(signal_region.massDiff_d0dstar, signal_region.pPslow, ',g')
+# 	pl.plot(background_sidebands.massDiff_d0dstar, background_sidebands.pPslow, ',r')
 # 	savefig('dm-pPslow-correlation')
 # 	pl.close()
 #
 # 	newfig()
-# 	pl.plot([f.massDiff_d0dstar for f in signal_region], [f.pPslow_t for f in signal_region], ',g')
-# 	pl.plot([f.massDiff_d0dstar for f in background_sidebands], [f.pPslow_t for f in background_sidebands], ',r')
+# 	pl.plot(signal_region.massDiff_d0dstar, signal_region.pPslow_t, ',g')
+# 	pl.plot(background_sidebands.massDiff_d0dstar, background_sidebands.pPslow_t, ',r')
 # 	savefig('dm-pPslow_t-correlation')
 # 	pl.close()
 #
 # 	fig, ax = newfig()
-# 	pl.semilogy([f.massDiff_d0dstar for f in signal_region if f.decayTime < 20e-12], [f.decayTime*1e12 for f in signal_region if f.decayTime < 20e-12], ',g')
-# 	pl.semilogy([f.massDiff_d0dstar for f in background_sidebands if f.decayTime < 20e-12], [f.decayTime*1e12 for f in background_sidebands if f.decayTime < 20e-12], ',r')
+# 	sr, bs = signal_region[signal_region.decayTime < 20e-12], background_sidebands[background_sidebands.decayTime < 20e-12]
+# 	pl.semilogy(sr.massDiff_d0dstar, sr.decayTime*1e12, ',g')
+# 	pl.semilogy(bs.massDiff_d0dstar, bs.decayTime*1e12, ',r')
 # 	ax.set_ylim(ymin=0.1, ymax=20)
 # 	savefig('dm-decayTime-correlation')
 # 	pl.close()
 #
 # 	newfig()
-# 	pl.plot([f.massDiff_d0dstar for f in signal_region], [f.d0IP_log for f in signal_region], ',g')
-# 	pl.plot([f.massDiff_d0dstar for f in background_sidebands], [f.d0IP_log for f in background_sidebands], ',r')
+# 	pl.plot(signal_region.massDiff_d0dstar, signal_region.d0IP_log, ',g')
+# 	pl.plot(background_sidebands.massDiff_d0dstar, background_sidebands.d0IP_log, ',r')
 # 	savefig('dm-d0IP_log-correlation')
 # 	pl.close()
 #
@@ -118,19 +130,24 @@ pl.close()
 
 
 print('cut')
-# filtered, rejected = cut(filtered, rejected, lambda d: 2500 <= d.pD0_t) # 4500, 2500
-# filtered, rejected = cut(filtered, rejected, lambda d: 1400 <= d.pDstar_t < 20000) # 2500, 1400
-# filtered, rejected = cut(filtered, rejected, lambda d: 200 <= d.pPslow_t < 2500) # 300, 200
-# filtered, rejected = cut(filtered, rejected, lambda d: 700 <= d.pk_t) # 1000, 700
-# filtered, rejected = cut(filtered, rejected, lambda d: 700 <= d.pp_t) # 1000, 700
+cuts = [
+# 	Cut('pD0_t', 2500), # 4500, 2500
+# 	Cut('pDstar_t', 1400, 20000), # 2500, 1400
+# 	Cut('pPslow_t', 200, 2500), # 300, 200
+# 	Cut('pk_t', 700), # 1000, 700
+# 	Cut('pp_t', 700), # 1000, 700
 
-# filtered, rejected = cut(filtered, rejected, lambda d: -5 <= d.d0IP_log <= -2.5)
-# filtered, rejected = cut(filtered, rejected, lambda d: -4 <= d.kIP_log <= -0.1)
-# filtered, rejected = cut(filtered, rejected, lambda d: -4 <= d.pIP_log <= -0.1)
-# filtered, rejected = cut(filtered, rejected, lambda d: -4 <= d.psIP_log <= -1.1)
+# 	Cut('d0IP_log', -5, -2.5),
+# 	Cut('kIP_log', -4, -0.1),
+# 	Cut('pIP_log', -4, -0.1),
+# 	Cut('psIP_log', -4, -1.1),
 
-# filtered, rejected = cut(filtered, rejected, lambda d:  20 <= d.s_z <= 120)
-# filtered, rejected = cut(filtered, rejected, lambda d:  .9995 <= d.costheta or d.costheta <= -.9995)
+# 	Cut('s_z', 20, 120),
+# 	Cut('costheta', -.9995, .9995, veto=True),
+]
+selection = Selection(filtered, cuts)
+selection.print_report()
+filtered, rejected = selection.accepted(filtered), selection.rejected(filtered)
 
 
 
@@ -139,25 +156,51 @@ add_int('num_events_before', len(data))
 # remove width
 d0_c, dstar_c = 1865., 2010.
 meson_mass_width = 30.
-filtered = [event for event in filtered if (d0_c - meson_mass_width) <= mass_toMeV(event.reconstructedD0Mass) <= (d0_c + meson_mass_width) and (dstar_c - meson_mass_width) <= mass_toMeV(event.reconstructedDstarMass) <= (dstar_c + meson_mass_width)]
+filtered = filtered[mass_window(filtered, d0_c, dstar_c, meson_mass_width)]
 
-after_po, after_bin_width = massDiff_plot(filtered, ext_name='after', bg_ratio=.01)
+after_po, after_bin_width = run_stage('massDiff-after', massDiff_fit, filtered, ext_name='after', bg_ratio=.01, use_cache=use_stage_cache)
 add_int('num_events', len(filtered))
 
 print('cut-done')
 
 
 
-# massDiff_plot(filtered, 'AFTER', 0)
-plotData(filtered)
-calculateLifetime(filtered, background_sidebands, after_po, after_bin_width, width)
+# massDiff_fit(filtered, 'AFTER', 0)
+# --fit-resolution takes the decay time resolution from the D* decay times rather than pdf_gaussian_width
+resolution_width = pdf_gaussian_width
+if '--fit-resolution' in sys.argv:
+	sidebands = SidebandModel(after_po, width)
+	sidebands.print_weights()
+	resolution_width = run_stage('resolution', fit_resolution, filtered, sidebands.wb, sidebands.range_low, sidebands.range_up, use_cache=use_stage_cache)
+
+# --per-event-resolution gives the lifetime fit the resolution of every event, from its D0 momentum and the flight
+# distance resolution, the other fits keep the single width
+lifetime_width = resolution_width
+if '--per-event-resolution' in sys.argv:
+	lifetime_width = decay_time_sigmas(filtered)
 
-# mass dist
-newfig()
-offs = [d.pPslow for d in filtered]
-pl.hist(offs, bins=100, histtype='step', fill=False)
-savefig('offsets')
-pl.close()
+save_fit_events(filtered)
+run_stage('lifetime', calculateLifetime, filtered, background_sidebands, after_po, after_bin_width, width, lifetime_width, \
+	fit_workers, depends=fit_range, use_cache=use_stage_cache)
 
+# --fit-2d fits the mass differences and decay times together as well, without sideband weights
+if '--fit-2d' in sys.argv:
+	run_stage('mass-time', mass_time_fit, filtered, after_po, resolution_width, fit_workers, depends=fit_range,
+		use_cache=use_stage_cache)
+
+# --toys fits toy data sets generated from the fits, and bootstrap resamples of the events, as the lifetime was
+# fitted, and prints the bias and coverage of the fit
+num_toys = 100
+if '--toys' in sys.argv:
+	tau = float(result_list['lifetime']['tau'])
+	print_summary(toy_study(num_toys, len(filtered), after_po, width, tau, resolution_width))
+	print_summary(bootstrap_study(num_toys, filtered.decayTime*1e12, filtered.massDiff_d0dstar, after_po, width, resolution_width))
 
 write_out()
+save_results()
+
+if plot:
+	queue_plot(plotData, data_histograms(filtered))
+	queue_plot(plot_offsets, Histogram.of(filtered.pPslow))
+	plot_results(load_results())
+	render_queued(skip_unchanged=not '--rerender' in sys.argv)
@@ -0,0 +1,257 @@
+import numpy as np
+import lazy_property
+from Background import c, e, m_pi, m_k
+
+
+# stack of position 3-vectors, shape (N, 3), units mm
+Positions = np.ndarray
+# stack of momentum 3-vectors, shape (N, 3), units MeV/c
+Momenta = np.ndarray
+
+
+def momentum_toSI(p: float):
+	return p * 1e6 * e / c # in SI
+
+def mass_toSI(p: float):
+	return p * 1e6 * e / c**2 # in SI
+
+def energy_toSI(p: float):
+	return p * 1e6 * e # in SI
+
+def momentum_toMeV(p: float):
+	return p * 1e-6 * c / e
+
+def mass_toMeV(p: float):
+	return p * 1e-6 * c**2 / e
+
+def energy_toMeV(p: float):
+	return p * 1e-6 / e
+
+
+# magnitude, unit vector and dot product of each row of v, one 3-vector
+def row_magnitude(v: Positions):
+	return np.sqrt(np.sum(v**2, axis=1))
+
+def row_normed(v: Positions):
+	return v/row_magnitude(v)[:, None]
+
+def row_dot(a: Positions, b: Positions):
+	return np.sum(a*b, axis=1)
+
+
+# Columnar store of a whole set of candidates: each vertex and momentum is one contiguous (N, 3) array, and
+# every derived quantity is computed for all events at once. test_events.py checks them against the formulas
+# worked one event at a time.
+class EventTable(object):
+
+	# the raw 3-vector columns, in constructor order
+	vectors = ['interaction', 'dstarDecay', 'd0Decay', 'bDecay', 'kp', 'pd', 'ps']
+
+	def __init__(self, interaction: Positions, dstarDecay: Positions, d0Decay: Positions, bDecay: Positions, kp: Momenta, pd: Momenta, ps: Momenta):
+		self.interaction = np.ascontiguousarray(interaction, dtype=np.float64)
+		self.dstarDecay = np.ascontiguousarray(dstarDecay, dtype=np.float64)
+		self.d0Decay = np.ascontiguousarray(d0Decay, dtype=np.float64)
+		self.bDecay = np.ascontiguousarray(bDecay, dtype=np.float64)
+		self.kp = np.ascontiguousarray(kp, dtype=np.float64)
+		self.pd = np.ascontiguousarray(pd, dtype=np.float64)
+		self.ps = np.ascontiguousarray(ps, dtype=np.float64)
+
+	@classmethod
+	def concatenate(cls, tables):
+		return cls(*[np.concatenate([getattr(t, name) for t in tables]) for name in cls.vectors])
+
+	def __len__(self):
+		return len(self.interaction)
+
+	def __repr__(self):
+		return super(EventTable, self).__repr__() + " (%d events)" % len(self)
+
+	# index with a boolean mask, slice or index array to get a sub table
+	# - derived columns that were already computed are carried across rather than recomputed
+	def __getitem__(self, idx):
+		sub = EventTable(*[getattr(self, name)[idx] for name in self.vectors])
+		for cache_name, col in self.__dict__.items():
+			if cache_name.startswith('_'):
+				setattr(sub, cache_name, col[idx])
+		return sub
+
+	@lazy_property.LazyProperty
+	def labFrameTravel(self):
+		return row_magnitude(self.dstarDecay-self.d0Decay) * 1e-3 # convert mm -> m
+
+	@lazy_property.LazyProperty
+	def dStarlabFrameTravel(self):
+		return row_magnitude(self.bDecay-self.dstarDecay) * 1e-3 # convert mm -> m
+
+	@lazy_property.LazyProperty
+	def pD0_t(self):
+		pcomps_d0 = self.kp+self.pd # in MeV
+		return row_magnitude(pcomps_d0[:, 0:1])
+
+	@lazy_property.LazyProperty
+	def pDstar_t(self):
+		pcomps_d0 = self.kp+self.pd+self.ps # in MeV
+		return row_magnitude(pcomps_d0[:, 0:1])
+
+	@lazy_property.LazyProperty
+	def pPslow(self):
+		return row_magnitude(self.ps)
+
+	@lazy_property.LazyProperty
+	def pPslow_t(self):
+		return row_magnitude(self.ps[:, 0:1])
+
+	@lazy_property.LazyProperty
+	def pD0(self):
+		return momentum_toSI(row_magnitude(self.kp+self.pd))
+
+	@lazy_property.LazyProperty
+	def pDstar(self):
+		return momentum_toSI(row_magnitude(self.kp+self.pd+self.ps))
+
+	@lazy_property.LazyProperty
+	def pDstar_comps(self):
+		return momentum_toSI(self.kp+self.pd+self.ps)
+
+	@lazy_property.LazyProperty
+	def pD0_comps(self):
+		return momentum_toSI(self.kp+self.pd)
+
+
+	def get_daughterEnergy(self, m_pi_si, m_k_si):
+		p_pi = momentum_toSI(row_magnitude(self.pd))
+		p_k = momentum_toSI(row_magnitude(self.kp))
+		return np.sqrt((p_pi*c)**2 + mass_toSI(m_pi_si)**2 * c**4)   +   np.sqrt((p_k*c)**2 + mass_toSI(m_k_si)**2 * c**4)
+
+	@lazy_property.LazyProperty
+	def daughterEnergy(self):
+		return self.get_daughterEnergy(m_pi, m_k)
+
+	@lazy_property.LazyProperty
+	def daughterEnergy_pp(self):
+		return self.get_daughterEnergy(m_pi, m_pi)
+
+	@lazy_property.LazyProperty
+	def daughterEnergy_kk(self):
+		return self.get_daughterEnergy(m_k, m_k)
+
+
+	def get_reconstructedMass(self, daughterEnergy):
+		return np.sqrt(daughterEnergy**2 - (self.pD0*c)**2)/c**2
+
+	@lazy_property.LazyProperty
+	def reconstructedD0Mass(self):
+		return self.get_reconstructedMass(self.daughterEnergy)
+
+	@lazy_property.LazyProperty
+	def reconstructedD0Mass_pp(self):
+		return self.get_reconstructedMass(self.daughterEnergy_pp)
+
+	@lazy_property.LazyProperty
+	def reconstructedD0Mass_kk(self):
+		return self.get_reconstructedMass(self.daughterEnergy_kk)
+
+
+	def get_dStarEnergy(self, daughterEnergy):
+		p_pislow = momentum_toSI(row_magnitude(self.ps))
+		m_pi_si = mass_toSI(m_pi)
+		return daughterEnergy + np.sqrt((p_pislow*c)**2 + m_pi_si**2 * c**4)
+
+	def get_reconstructedDstarMass(self, starEnergy):
+		return np.sqrt(starEnergy**2 - np.abs(self.pDstar*c)**2)/c**2
+
+	@lazy_property.LazyProperty
+	def dStarEnergy(self):
+		return self.get_dStarEnergy(self.daughterEnergy)
+
+	@lazy_property.LazyProperty
+	def reconstructedDstarMass(self):
+		return self.get_reconstructedDstarMass(self.dStarEnergy)
+
+	# in MeV
+	@lazy_property.LazyProperty
+	def massDiff_d0dstar(self):
+		return mass_toMeV(self.reconstructedDstarMass - self.reconstructedD0Mass)
+
+	@lazy_property.LazyProperty
+	def dStarEnergy_kk(self):
+		return self.get_dStarEnergy(self.daughterEnergy_kk)
+
+	@lazy_property.LazyProperty
+	def reconstructedDstarMass_kk(self):
+		return self.get_reconstructedDstarMass(self.dStarEnergy_kk)
+
+	# in MeV
+	@lazy_property.LazyProperty
+	def massDiff_d0dstar_kk(self):
+		return mass_toMeV(self.reconstructedDstarMass_kk - self.reconstructedD0Mass_kk)
+
+	@lazy_property.LazyProperty
+	def dStarEnergy_pp(self):
+		return self.get_dStarEnergy(self.daughterEnergy_pp)
+
+	@lazy_property.LazyProperty
+	def reconstructedDstarMass_pp(self):
+		return self.get_reconstructedDstarMass(self.dStarEnergy_pp)
+
+	# in MeV
+	@lazy_property.LazyProperty
+	def massDiff_d0dstar_pp(self):
+		return mass_toMeV(self.reconstructedDstarMass_pp - self.reconstructedD0Mass_pp)
+
+
+	@lazy_property.LazyProperty
+	def gamma(self):
+		return self.pD0 / (c * self.reconstructedD0Mass)
+
+	@lazy_property.LazyProperty
+	def decayTime(self):
+		x = (self.d0Decay-self.bDecay)*1e-3
+		p_d0 = self.pD0_comps
+		return np.sign(row_dot(x, p_d0)) * row_magnitude(x) * self.reconstructedD0Mass / row_magnitude(p_d0)
+
+	@lazy_property.LazyProperty
+	def dStarDecayTime(self):
+		x = (self.dstarDecay-self.bDecay)*1e-3
+		p_ds = self.pDstar_comps
+		return np.sign(row_dot(x, p_ds)) * row_magnitude(x) * self.reconstructedDstarMass / row_magnitude(p_ds)
+
+
+	# log10 of the impact parameter (in mm) of the track with momentum p wrt the D* vertex
+	def get_IP_log(self, p: Momenta):
+		x = (self.d0Decay - self.dstarDecay)*1e-3
+		p = row_normed(momentum_toSI(p))
+		return np.log10(row_magnitude(x - row_dot(x, p)[:, None] * p)*1e3)
+
+	@lazy_property.LazyProperty
+	def d0IP_log(self):
+		return self.get_IP_log(self.kp+self.pd)
+
+	@lazy_property.LazyProperty
+	def kIP_log(self):
+		return self.get_IP_log(self.kp)
+
+	@lazy_property.LazyProperty
+	def pIP_log(self):
+		return self.get_IP_log(self.pd)
+
+	@lazy_property.LazyProperty
+	def psIP_log(self):
+		return self.get_IP_log(self.ps)
+
+	@lazy_property.LazyProperty
+	def pk_t(self):
+		return row_magnitude(self.kp[:, 0:1])
+
+	@lazy_property.LazyProperty
+	def pp_t(self):
+		return row_magnitude(self.pd[:, 0:1])
+
+	@lazy_property.LazyProperty
+	def s_z(self):
+		return self.dstarDecay[:, 2] - self.interaction[:, 2]
+
+	@lazy_property.LazyProperty
+	def costheta(self):
+		p, r = self.kp+self.pd, self.d0Decay-self.dstarDecay
+		return row_dot(row_normed(p), row_normed(r))
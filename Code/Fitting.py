@@ -1,58 +1,264 @@
 from typing import Text
 import csv
+import os
 import numpy as np
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from scipy.constants import c, hbar, physical_constants
-from scipy.misc import derivative
-import pylab as pl
 import scipy.optimize as spo
+from scipy.interpolate import CubicSpline
 import lazy_property
 from Background import *
-from style import *
+from Events import EventTable
+from Likelihood import fit_mass_time
+from Shared import SharedArrays, worker, init_worker
 
 
-def maximum_likelyhood_exp_fit(full_set, after_po, deltamass_peak_width, dm_uncert=None):
+fit_range = (0, 10)
+pdf_gaussian_width = 1./7.5
+# D0 flight distance resolution in mm, for decay_time_sigmas, the median width it gives is about pdf_gaussian_width
+flight_resolution = 1.1
+
+
+# s is the decay time resolution width in ps, or an array of the width of every event in full_set
+# - workers other than 1 evaluates the likelihood across a process pool, see ParallelLikelihood
+def maximum_likelyhood_exp_fit(full_set, after_po, deltamass_peak_width, dm_uncert=None, s=pdf_gaussian_width, workers=1):
 
-	np.save('fitting_FULLSET.npy', full_set)
 # 	np.save('fitting_AFTERPO.npy', after_po)
 # 	np.save('fitting_WIDTH.npy', [deltamass_peak_width])
 
-	range_low, range_up = get_sig_range(after_po, deltamass_peak_width)
-	print(range_low, range_up)
+	sidebands = SidebandModel(after_po, deltamass_peak_width)
+	print(sidebands.range_low, sidebands.range_up)
+
+	in_range = (fit_range[0] <= full_set.decayTime*1e-12) & (full_set.decayTime*1e-12 <= fit_range[1])
+	data = full_set[in_range]
+	if np.ndim(s):
+		s = s[in_range]
+
+	sidebands.print_weights()
+	wb = sidebands.wb
+
+	times = data.decayTime*1e12 #decay times considered from data
+	weights = sidebands.weights(data.massDiff_d0dstar) # sideband events are weighted by wb
+
+	tau_f, S, A, scan = fit_lifetime(times, weights, s=s, workers=workers)
+	return tau_f, S, wb, s, A, scan
+
+
+# extended unbinned fit of the mass differences and decay times together (Likelihood.fit_mass_time), in place of
+# the sideband weights of maximum_likelyhood_exp_fit, with the resolution width fixed at s
+def mass_time_fit(full_set, after_po, s=pdf_gaussian_width, workers=1):
+	res = fit_mass_time(full_set.massDiff_d0dstar, full_set.decayTime*1e12, after_po, t_range=fit_range, fixed={'s': s}, workers=workers)
+	values, errors = dict(zip(res.names, res.values)), dict(zip(res.names, res.errors))
+	print('lifetime 2d', values['tau'], '+-', errors['tau'], 'ps, background lifetime', values['tau_bg'])
+
+	add_result('mass-time', names=res.names, values=res.values, errors=res.errors)
+	add_val('lifetime_2d', values['tau']*1e3)
+	add_val('error_2d', errors['tau']*1e3)
+	add_val('tau_bg_2d', values['tau_bg']*1e3)
+	add_int('sig_2d', values['n_sig'])
+	add_int('bg_2d', values['n_bg'])
+	return res
+
+
+# decay time resolution of every event in ps, from the resolution of the D0 flight distance in mm
+# - t = L m/p, so the D0 mass and momentum scale the flight distance resolution to a time resolution
+def decay_time_sigmas(events, flight_resolution=flight_resolution):
+	return flight_resolution*1e-3 * events.reconstructedD0Mass / events.pD0 * 1e12
+
+# a single width in place of per event widths s, their median, for what takes one width, e.g. the plotted curve
+def representative_width(s):
+	return float(np.median(s)) if np.ndim(s) else s
+
+
+# The lifetime likelihood takes the resolution width s either as one width for all the events, or as an array
+# with the width of every event. Every event then has its own normalisation over the fit range, which is
+# evaluated in closed form for all of them at once, so the fit costs the same either way.
+
+# weighted NLL, -sum(w log(f/I))
+def lifetime_nll(tau, times, weights, s=pdf_gaussian_width, range=fit_range):
+	I = convoluted_exponential_integral(range, tau, s)[0]
+	return -np.dot(weights, convoluted_exponential_log(times, tau, s) - np.log(I))
+
+# first and second derivatives wrt tau of the weighted NLL, in closed form
+# - one pass over the events, and no numerical differentiation of the quad normalisation
+def lifetime_nll_derivatives(tau, times, weights, s=pdf_gaussian_width, range=fit_range):
+	d1, d2 = convoluted_exponential_dtau(times, tau, s)
+	I, dI, d2I = convoluted_exponential_integral(range, tau, s)
+	if np.ndim(s):
+		return -np.dot(weights, d1 - dI/I), -np.dot(weights, d2 - (d2I/I - (dI/I)**2))
+	W = np.sum(weights)
+	return -np.dot(weights, d1) + W*dI/I, -np.dot(weights, d2) + W*(d2I/I - (dI/I)**2)
+
+
+# weighted NLL at every tau in taus, evaluated as one (taus, events) grid
+# - the events are taken max_elements/len(taus) at a time, so memory stays bounded for big grids and data sets
+# - returns the NLL curve and the (tau_min, low, up) interval where it is within up_nll of its minimum
+# - dtype=np.float32 evaluates the log densities of the grid in single precision, which halves its memory, they
+#   are still summed in double precision
+def likelihood_scan(taus, times, weights, s=pdf_gaussian_width, range=fit_range, up_nll=.5, max_elements=1 << 24, dtype=np.float64):
+	taus = np.unique(taus)
+	nll = scan_nll(taus, times, weights, s, range, max_elements, dtype)
+	return taus, nll, scan_interval(taus, nll, up_nll)
+
+# the weighted NLL at every tau in taus, which must be sorted and unique
+def scan_nll(taus, times, weights, s=pdf_gaussian_width, range=fit_range, max_elements=1 << 24, dtype=np.float64):
+	times, weights = np.asarray(times, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+	per_event = np.ndim(s) > 0
+
+	if per_event:
+		s = np.asarray(s, dtype=np.float64)
+		nll = np.zeros(len(taus))
+	else:
+		I = convoluted_exponential_cdf(range[1], taus, s) - convoluted_exponential_cdf(range[0], taus, s)
+		nll = np.sum(weights)*np.log(I)
+	chunk = max(1, max_elements // len(taus))
+	for start in np.arange(0, len(times), chunk):
+		ts, ws = times[start:start+chunk], weights[start:start+chunk]
+		ss = s[None, start:start+chunk] if per_event else s
+		if per_event:
+			I = convoluted_exponential_cdf(range[1], taus[:, None], ss) - convoluted_exponential_cdf(range[0], taus[:, None], ss)
+			nll += np.log(I) @ ws
+		nll -= convoluted_exponential_log(ts[None, :], taus[:, None], ss, dtype) @ ws
+	return nll
+
+
+# The NLL, its derivatives and the scan are all sums over the events, so they split into partial sums over
+# slices of the events. ParallelLikelihood puts the events in shared memory once, every worker process works
+# out the partial sums of one slice, and they are added up here.
 
-	fit_range = (0, 10)
-	pdf_gaussian_width = 1./7.5
+# times, weights and s of the events start:stop
+def event_slice(start, stop):
+	arrays = worker['arrays']
+	s = arrays['s'][start:stop] if 's' in arrays else worker['s']
+	return arrays['times'][start:stop], arrays['weights'][start:stop], s
 
-	data = [event for event in full_set if fit_range[0] <= event.decayTime*1e-12 <= fit_range[1]]
+def partial_nll(tau, start, stop):
+	return lifetime_nll(tau, *event_slice(start, stop), worker['range'])
 
-	wb = calculate_weight(after_po, data, range_low, range_up)
+def partial_derivatives(tau, start, stop):
+	return lifetime_nll_derivatives(tau, *event_slice(start, stop), worker['range'])
 
-	times = [d.decayTime*1e12 for d in data] #decay times considered from data
-	mass_diffs = [event.massDiff_d0dstar for event in data] #decay times considered from data
+def partial_scan(taus, start, stop):
+	return scan_nll(taus, *event_slice(start, stop), worker['range'])
 
 
-	def pdf(ti, tau, A):
-		return convoluted_exponential(ti, A, tau, pdf_gaussian_width)
+# lifetime_nll, lifetime_nll_derivatives and likelihood_scan of the events, evaluated across a process pool
+# - the events are split into one slice per worker (workers=None is all the cores)
+# - use it as a context manager, or close it, to stop the workers and free the shared memory
+class ParallelLikelihood(object):
 
-	def negative_log_likelihood(tau, ts, mdiffs): #ts, mdiffs are the events' times and mass diffs, l is lifetime
-		normalisation = normalisation_const(convoluted_exponential, fit_range, (1, tau, pdf_gaussian_width))
-		aaa = [(1 if range_low <= md <= range_up else wb) * np.log(pdf(x, tau, normalisation)) for x, md in zip(ts, mass_diffs)]
-		s = -sum(aaa)
-		print(s, tau)
-		return s
+	def __init__(self, times, weights, s=pdf_gaussian_width, workers=None, range=fit_range):
+		arrays = {'times': np.asarray(times, dtype=np.float64), 'weights': np.asarray(weights, dtype=np.float64)}
+		if np.ndim(s):
+			arrays['s'] = np.asarray(s, dtype=np.float64)
+		num_slices = workers or os.cpu_count()
+		edges = np.linspace(0, len(arrays['times']), num_slices+1).astype(int)
+		self.starts, self.stops = list(edges[:-1]), list(edges[1:])
 
-	def D_Dtau(tau_x, ts, mdiffs): #first derivative wrt tau
-		return derivative(negative_log_likelihood, tau_x, args=(times, mdiffs), dx=1e-5)
+		self.shared = SharedArrays(arrays)
+		self.pool = ProcessPoolExecutor(num_slices, initializer=init_worker, initargs=(self.shared.spec, {'s': s, 'range': range}))
 
-	def D_2_Dtau(tau_x, ts, mdiffs):
-		return derivative(negative_log_likelihood, tau_x, args=(times, mdiffs), n=2, dx=1e-5)
+	# func(arg, start, stop) of every slice, added up
+	def reduce(self, func, arg):
+		return np.sum(list(self.pool.map(func, [arg]*len(self.starts), self.starts, self.stops)), axis=0)
+
+	def nll(self, tau):
+		return self.reduce(partial_nll, tau)
+
+	def derivatives(self, tau):
+		return tuple(self.reduce(partial_derivatives, tau))
+
+	def scan(self, taus, up_nll=.5):
+		taus = np.unique(taus)
+		nll = self.reduce(partial_scan, taus)
+		return taus, nll, scan_interval(taus, nll, up_nll)
+
+	def close(self):
+		self.pool.shutdown()
+		self.shared.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+# minimum of a scanned NLL curve and where it crosses min + up_nll either side, from a cubic spline through it
+def scan_interval(taus, nll, up_nll=.5):
+	spline = CubicSpline(taus, nll)
+	i = np.argmin(nll)
+	if i == 0 or i == len(taus)-1:
+		raise ValueError('NLL minimum at the edge of the scan, widen the tau grid')
+
+	tau_min = spo.minimize_scalar(spline, bounds=(taus[i-1], taus[i+1]), method='bounded').x
+	threshold = spline(tau_min) + up_nll
+	below = np.nonzero((taus < tau_min) & (nll > threshold))[0]
+	above = np.nonzero((taus > tau_min) & (nll > threshold))[0]
+	if not len(below) or not len(above):
+		raise ValueError('NLL doesn\'t rise by %g within the scan, widen the tau grid' % up_nll)
+
+	low = spo.brentq(lambda t: spline(t) - threshold, taus[below[-1]], tau_min)
+	up = spo.brentq(lambda t: spline(t) - threshold, tau_min, taus[above[0]])
+	return tau_min, low, up
+
+
+# weighted unbinned ML fit of convoluted_exponential to the decay times, returns the lifetime, its error, normalisation
+# and the (taus, nll) likelihood scan the error is taken from
+# - times can also be bin centroids with weights the summed weight in each bin, which is what the streaming pipeline passes
+# - analytic: Newton-Raphson steps use lifetime_nll_derivatives rather than finite differences with dx=1e-5
+# - s is the resolution width, or an array of the width of every event, A is then the normalisation of every event
+# - workers other than 1 evaluates the NLL, its derivatives and the scan across a process pool, with likelihood the
+#   ParallelLikelihood of the events
+# - verbose=False fits without printing, e.g. for the toys
+def fit_lifetime(times, weights, analytic=True, s=pdf_gaussian_width, workers=1, likelihood=None, verbose=True):
+	times, weights = np.asarray(times, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+	if workers != 1 and likelihood is None:
+		with ParallelLikelihood(times, weights, s, workers) as likelihood:
+			return fit_lifetime(times, weights, analytic, s, likelihood=likelihood, verbose=verbose)
+
+	def negative_log_likelihood(tau, ts, ws): #ts, ws are arrays of the events' times and weights, tau is lifetime
+		if likelihood is not None:
+			nll = likelihood.nll(tau)
+		elif np.ndim(s):
+			nll = lifetime_nll(tau, ts, ws, s)
+		else:
+			normalisation = normalisation_const(convoluted_exponential, fit_range, (1, tau, s))
+			nll = -np.dot(ws, convoluted_exponential_log(ts, tau, s) + np.log(normalisation))
+		if verbose:
+			print(nll, tau)
+		return nll
+
+	# central differences, as scipy.misc.derivative took them before it was removed
+	dx = 1e-5
+
+	def D_Dtau(tau_x, ts, ws): #first derivative wrt tau
+		if analytic and likelihood is not None:
+			return likelihood.derivatives(tau_x)[0]
+		if analytic:
+			return lifetime_nll_derivatives(tau_x, ts, ws, s)[0]
+		return (negative_log_likelihood(tau_x+dx, ts, ws) - negative_log_likelihood(tau_x-dx, ts, ws))/(2*dx)
+
+	def D_2_Dtau(tau_x, ts, ws):
+		return (negative_log_likelihood(tau_x+dx, ts, ws) - 2*negative_log_likelihood(tau_x, ts, ws) + \
+			negative_log_likelihood(tau_x-dx, ts, ws))/dx**2
+
+	def D_D_2_Dtau(tau_x, ts, ws): #first and second derivatives, in one pass when analytic
+		if analytic and likelihood is not None:
+			return likelihood.derivatives(tau_x)
+		if analytic:
+			return lifetime_nll_derivatives(tau_x, ts, ws, s)
+		return D_Dtau(tau_x, ts, ws), D_2_Dtau(tau_x, ts, ws)
 
 	# takes tau: initial guess of derivative root
 	def Newton_Raphson_tau(tau0): #iterates and finds the root of the derivative (minimum of log likelihood)
 		tau_n = tau0
 		while True:
-			tau_change = D_Dtau(tau_n, times, mass_diffs)/D_2_Dtau(tau_n, times, mass_diffs)
-			print('nr', tau_n-tau_change)
+			d1, d2 = D_D_2_Dtau(tau_n, times, weights)
+			tau_change = d1/d2
+			if verbose:
+				print('nr', tau_n-tau_change)
 			if np.abs(tau_change) <= 1e-4:
 				return tau_n-tau_change
 			else:
@@ -60,31 +266,26 @@ def maximum_likelyhood_exp_fit(full_set, after_po, deltamass_peak_width, dm_unce
 
 
 	tau_f = Newton_Raphson_tau(0.4)
-	print('tau', tau_f, np.mean(times))
+	if verbose:
+		print('tau', tau_f, np.mean(times))
 
-	newfig(0.65 if is_latex else 2)
-	x = np.linspace(.25, .65, 100)
-	A = normalisation_const(convoluted_exponential, fit_range, (1, tau_f, pdf_gaussian_width))
-	pl.plot(x, [negative_log_likelihood(x, times, mass_diffs) for x in x])
-	pl.xlabel(r'$\tau$ [ps]')
-	pl.ylabel(r'$- \log{\mathcal{L}}$')
-	savefig('L vs tau')
-
-	likelyhood = negative_log_likelihood(tau_f, times, mass_diffs)
+	if np.ndim(s):
+		A = 1/convoluted_exponential_integral(fit_range, tau_f, s)[0]
+	else:
+		A = normalisation_const(convoluted_exponential, fit_range, (1, tau_f, s))
 
 	#statistical uncertainty calculations
-	def Neg_Log_1(tau): #Neg Log likelihood shifted by a threshold
-		return negative_log_likelihood(tau, times, mass_diffs) - likelyhood - .5
-
-	def Newton_Raphson_uncertainty(x): #finds the root of Neg_Log_1
-		while np.abs(Neg_Log_1(x)) >= 0.005:
-			x_n = x - Neg_Log_1(x)/D_Dtau(x, times, mass_diffs)
-			x=x_n
-		return x
-
-	x_1 = Newton_Raphson_uncertainty(tau_f - 0.01)
-	x_2 = Newton_Raphson_uncertainty(tau_f + 0.01)
+	# one scan gives the L vs tau curve and the NLL = min + 0.5 crossings, it is fine around tau_f (where the
+	# parabolic error from the second derivative says the crossings are) and coarse over the plotted range
+	S_estimate = 1/np.sqrt(D_D_2_Dtau(tau_f, times, weights)[1])
+	x = np.linspace(.25, .65, 100)
+	x_fine = tau_f + S_estimate*np.linspace(-3, 3, 61)
+	if likelihood is not None:
+		taus, nll, (_, x_1, x_2) = likelihood.scan(np.concatenate([x, x_fine]))
+	else:
+		taus, nll, (_, x_1, x_2) = likelihood_scan(np.concatenate([x, x_fine]), times, weights, s)
 	S = np.abs(x_1 - x_2)/2
 
-	print('lifetime ', tau_f, '+- ', S, ' ps')
-	return tau_f, S, wb, pdf_gaussian_width, A
+	if verbose:
+		print('lifetime ', tau_f, '+- ', S, ' ps')
+	return tau_f, S, A, (taus, nll)
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+# the range np.histogram bins values from low to up over, it widens a single value to a unit range
+def data_range(low, up):
+	return (low, up) if low < up else (low - .5, up + .5)
+
+
+# Fixed binning histogram that is filled a chunk at a time, so the events never have to be held together.
+# - counts: number of entries, sumw: sum of weights, sumw2: sum of squared weights, for the errors of weighted
+#   bins, sumx: sum of the (unweighted) values, for bin centroids
+# - histograms with the same binning filled from different chunks, e.g. in different worker processes, merge
+#   into the histogram of all of them, and save and load as .npz files
+class Histogram(object):
+
+	def __init__(self, bins, range):
+		self.bins = bins
+		self.range = range
+		self.edges = np.linspace(range[0], range[1], bins+1)
+		self.counts = np.zeros(bins)
+		self.sumw = np.zeros(bins)
+		self.sumw2 = np.zeros(bins)
+		self.sumx = np.zeros(bins)
+
+	# histogram of x over its whole range, like np.histogram(x, bins)
+	@classmethod
+	def of(cls, x, bins=100, weights=None):
+		x = np.asarray(x)
+		hist = cls(bins, data_range(np.min(x), np.max(x)) if len(x) else (0, 1))
+		hist.fill(x, weights)
+		return hist
+
+	# adds the values in x that fall inside range, in the same bins as np.histogram, the last bin includes the upper edge
+	def fill(self, x, weights=None):
+		x = np.asarray(x)
+		low, up = self.range
+		inside = (low <= x) & (x <= up)
+		x = x[inside]
+		idx = np.minimum(((x - low) * (self.bins / (up - low))).astype(np.intp), self.bins-1)
+		# values within rounding of an edge go to the bin np.histogram puts them in
+		idx[x < self.edges[idx]] -= 1
+		idx[(x >= self.edges[idx+1]) & (idx != self.bins-1)] += 1
+
+		counts = np.bincount(idx, minlength=self.bins)
+		self.counts += counts
+		if weights is None:
+			self.sumw += counts
+			self.sumw2 += counts
+		else:
+			weights = np.asarray(weights)[inside]
+			self.sumw += np.bincount(idx, weights=weights, minlength=self.bins)
+			self.sumw2 += np.bincount(idx, weights=weights**2, minlength=self.bins)
+		self.sumx += np.bincount(idx, weights=x, minlength=self.bins)
+
+	# adds the entries of other, which must have the same binning, returns self
+	def merge(self, other):
+		if self.bins != other.bins or tuple(self.range) != tuple(other.range):
+			raise ValueError('histograms have different binning, %d bins over %s and %d over %s' % \
+				(self.bins, self.range, other.bins, other.range))
+		self.counts += other.counts
+		self.sumw += other.sumw
+		self.sumw2 += other.sumw2
+		self.sumx += other.sumx
+		return self
+
+	def copy(self):
+		return Histogram(self.bins, self.range).merge(self)
+
+	def save(self, path):
+		np.savez(path, range=self.range, counts=self.counts, sumw=self.sumw, sumw2=self.sumw2, sumx=self.sumx)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as f:
+			hist = cls(len(f['counts']), tuple(f['range']))
+			for name in ('counts', 'sumw', 'sumw2', 'sumx'):
+				setattr(hist, name, f[name])
+		return hist
+
+	@property
+	def bin_width(self):
+		return self.edges[1] - self.edges[0]
+
+	# sqrt(sum(w^2)), which is sqrt(counts) when the entries aren't weighted
+	@property
+	def errors(self):
+		return np.sqrt(self.sumw2)
+
+	# mean of the values in each bin, or the bin centre if it is empty
+	@property
+	def centroids(self):
+		centres = (self.edges[1:] + self.edges[:-1])/2
+		return np.divide(self.sumx, self.counts, out=centres, where=self.counts > 0)
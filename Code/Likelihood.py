@@ -0,0 +1,292 @@
+import numpy as np
+import scipy.optimize as spo
+import functools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from Background import convoluted_exponential_log, convoluted_exponential_integral, signal_integral, background_integral
+from Shared import SharedArrays, worker, init_worker
+
+
+FitResult = namedtuple('FitResult', ['names', 'values', 'errors', 'covariance', 'nll'])
+
+
+# Weighted unbinned maximum likelihood fit over several free parameters.
+# - log_pdf(*data, *params) returns the normalised log density of every event, as one array
+# - data is an array, or a tuple of arrays for pdfs of several variables
+# - any parameter can be fixed for a fit, so the same model fits with or without e.g. the resolution floating
+# - expected(*params) makes it an extended fit, it is the expected number of events, which is added to the NLL,
+#   and log_pdf is then the log of the expected event density
+# - with workers other than 1 (None is all the cores), fit splits the events into chunks of chunk_size and sums
+#   the NLL of the chunks across a process pool, which reads the events from shared memory, log_pdf must then
+#   be picklable, e.g. a module level function or a functools.partial of one
+class UnbinnedFit(object):
+
+	def __init__(self, log_pdf, names, data, weights=None, expected=None, workers=1, chunk_size=1 << 18):
+		self.log_pdf = log_pdf
+		self.names = list(names)
+		self.data = data if isinstance(data, tuple) else (data,)
+		self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+		self.expected = expected
+		self.workers, self.chunk_size = workers, chunk_size
+		self.pool = None
+
+	def nll(self, params):
+		if self.pool is None:
+			nll = events_nll(self.log_pdf, self.data, self.weights, params)
+		else:
+			starts = range(0, len(self.data[0]), self.chunk_size)
+			nll = sum(self.pool.map(chunk_nll, [params]*len(starts), starts, [self.chunk_size]*len(starts)))
+		if self.expected is not None:
+			nll += self.expected(*params)
+		return nll
+
+	# initial and bounds are dicts of parameter name -> value and name -> (low, up), fixed is name -> value
+	# - covariance='hessian' is the inverse Hessian of the NLL at the minimum
+	# - covariance='sandwich' is H^-1 C H^-1 with C = sum(w^2 g g^T) over the per event gradients g, which
+	#   is the right error when the weights aren't all 1, e.g. with negative sideband weights
+	# - parameters that end on a bound, and those the NLL then doesn't depend on, have nan errors
+	def fit(self, initial, bounds={}, fixed={}, covariance='hessian'):
+		if self.workers == 1 or len(self.data[0]) <= self.chunk_size:
+			return self.fit_events(initial, bounds, fixed, covariance)
+		arrays = {'data%d' % i: d for i, d in enumerate(self.data)}
+		if self.weights is not None:
+			arrays['weights'] = self.weights
+		with SharedArrays(arrays) as shared, ProcessPoolExecutor(self.workers, initializer=init_worker, \
+				initargs=(shared.spec, {'log_pdf': self.log_pdf, 'num_data': len(self.data)})) as pool:
+			self.pool = pool
+			try:
+				return self.fit_events(initial, bounds, fixed, covariance)
+			finally:
+				self.pool = None
+
+	def fit_events(self, initial, bounds, fixed, covariance):
+		free = [n for n in self.names if n not in fixed]
+
+		def all_params(x):
+			values = dict(fixed)
+			values.update(zip(free, x))
+			return [values[n] for n in self.names]
+
+		def nll_free(x):
+			return self.nll(all_params(x))
+
+		limits = [bounds.get(n, (None, None)) for n in free]
+		res = spo.minimize(nll_free, [initial[n] for n in free], method='L-BFGS-B', \
+			bounds=limits, options={'ftol': 1e-14, 'gtol': 1e-8})
+		x = res.x
+
+		# x with the parameters idx set to y, the NLL as a function of them, and their bounds
+		def with_values(idx, y):
+			z = x.copy()
+			z[idx] = y
+			return z
+
+		def nll_of(idx):
+			return lambda y: nll_free(with_values(idx, y))
+
+		def limits_of(idx):
+			return [limits[i] for i in idx]
+
+		# parameters that end on a bound stay there, the Newton step and the errors are those of the others
+		vary = np.flatnonzero(~at_bound(x, limits))
+
+		# one Newton step from the quasi-Newton minimum to polish it, if it stays in bounds and improves the NLL
+		try:
+			nll_vary, y, y_limits = nll_of(vary), x[vary], limits_of(vary)
+			step = np.linalg.solve(hessian(nll_vary, y, y_limits), gradient(nll_vary, y, y_limits))
+			polished = with_values(vary, x[vary] - step)
+			if in_bounds(polished, limits) and nll_free(polished) < nll_free(x):
+				x = polished
+		except np.linalg.LinAlgError:
+			pass
+
+		H = hessian(nll_of(vary), x[vary], limits_of(vary))
+		# the parameters the NLL doesn't depend on there have no error either, e.g. tau_bg with f_bg at 0
+		d = np.diag(H)
+		known = np.isfinite(d) & (d > 0)
+		idx, H = vary[known], H[np.ix_(known, known)]
+		cov = np.full((len(free), len(free)), np.nan)
+		if is_invertible(H):
+			cov_idx = np.linalg.inv(H)
+			if covariance == 'sandwich' and self.weights is not None:
+				g = event_gradients(lambda y: self.log_pdf(*self.data, *all_params(with_values(idx, y))), x[idx], limits_of(idx))
+				C = (g * self.weights[:, None]**2).T @ g
+				cov_idx = cov_idx @ C @ cov_idx
+			cov[np.ix_(idx, idx)] = cov_idx
+		else:
+			print('fit: the Hessian is singular, the parameters have no errors')
+
+		return FitResult(free, x, np.sqrt(np.diag(cov)), cov, nll_free(x))
+
+
+# -sum(w log_p) of the events
+def events_nll(log_pdf, data, weights, params):
+	log_p = log_pdf(*data, *params)
+	if weights is None:
+		return -np.sum(log_p)
+	return -np.dot(weights, log_p)
+
+# NLL of the events start:start+size, in a worker of a parallel fit, which reads them from shared memory
+def chunk_nll(params, start, size):
+	arrays = worker['arrays']
+	data = [arrays['data%d' % i][start:start+size] for i in range(worker['num_data'])]
+	weights = arrays['weights'][start:start+size] if 'weights' in arrays else None
+	return events_nll(worker['log_pdf'], data, weights, params)
+
+
+def in_bounds(x, bounds):
+	return all((low is None or low <= v) and (up is None or v <= up) for v, (low, up) in zip(x, bounds))
+
+# parameters that are on one of their bounds
+def at_bound(x, bounds):
+	def on(v, b):
+		return b is not None and abs(v - b) <= 1e-12*max(1, abs(b))
+	return np.array([on(v, low) or on(v, up) for v, (low, up) in zip(x, bounds)], dtype=bool)
+
+# a well conditioned correlation matrix, so the inverse means something, H has a positive diagonal
+def is_invertible(H):
+	if len(H) == 0 or not np.all(np.isfinite(H)):
+		return False
+	d = np.sqrt(np.diag(H))
+	return np.linalg.cond(H/np.outer(d, d)) < 1e12
+
+# finite difference step of every parameter and whether it can step both ways, central, within bounds
+# - a parameter that can't steps one way only, away from the bound it is near, the step is then negative near
+#   an upper bound
+def step_sizes(x, bounds=None):
+	h = 1e-4 * np.maximum(np.abs(x), 1e-2)
+	central = np.ones(len(x), dtype=bool)
+	for i, (low, up) in enumerate(bounds or []):
+		if up is not None and x[i] + h[i] > up:
+			h[i], central[i] = -h[i], False
+		elif low is not None and x[i] - h[i] < low:
+			central[i] = False
+	return h, central
+
+# derivative of f at x along the step e of length h, central or one sided, second order either way
+def difference(f, x, e, h, central, f0):
+	if central:
+		return (f(x + e) - f(x - e))/(2*h)
+	return (4*f(x + e) - 3*f0 - f(x + 2*e))/(2*h)
+
+def gradient(f, x, bounds=None):
+	x = np.asarray(x, dtype=np.float64)
+	h, central = step_sizes(x, bounds)
+	f0 = f(x)
+	return np.array([difference(f, x, e, h[i], central[i], f0) for i, e in enumerate(np.diag(h))])
+
+# finite difference Hessian of f at x, central where it can be and one sided next to bounds
+def hessian(f, x, bounds=None):
+	x = np.asarray(x, dtype=np.float64)
+	h, central = step_sizes(x, bounds)
+	n = len(x)
+	steps = np.diag(h)
+	H = np.empty((n, n))
+	f0 = f(x)
+	for i in range(n):
+		ei = steps[i]
+		if central[i]:
+			H[i, i] = (f(x + ei) - 2*f0 + f(x - ei))/h[i]**2
+		else:
+			H[i, i] = (f(x + 2*ei) - 2*f(x + ei) + f0)/h[i]**2
+		for j in range(i):
+			ej = steps[j]
+			if central[i] and central[j]:
+				H[i, j] = (f(x + ei + ej) - f(x + ei - ej) - f(x - ei + ej) + f(x - ei - ej))/(4*h[i]*h[j])
+			else:
+				H[i, j] = (f(x + ei + ej) - f(x + ei) - f(x + ej) + f0)/(h[i]*h[j])
+			H[j, i] = H[i, j]
+	return H
+
+# (events, params) finite difference gradients of the per event log densities
+def event_gradients(log_p, x, bounds=None):
+	h, central = step_sizes(x, bounds)
+	log_p0 = log_p(x)
+	return np.column_stack([difference(log_p, x, e, h[i], central[i], log_p0) for i, e in enumerate(np.diag(h))])
+
+
+# Vectorized decay time models, each normalised over the fit range.
+
+# convoluted_exponential with lifetime tau, resolution width s, shifted by a time offset t0
+def lifetime_log_pdf(range):
+	def log_pdf(t, tau, s, t0):
+		I = convoluted_exponential_integral((range[0]-t0, range[1]-t0), tau, s)[0]
+		return convoluted_exponential_log(t - t0, tau, s) - np.log(I)
+	return log_pdf
+
+# signal plus a fraction f_bg of background with its own lifetime tau_bg, both with the same resolution
+def lifetime_bg_log_pdf(range):
+	def log_pdf(t, tau, s, t0, f_bg, tau_bg):
+		shifted = (range[0]-t0, range[1]-t0)
+		sig = convoluted_exponential_log(t - t0, tau, s) - np.log(convoluted_exponential_integral(shifted, tau, s)[0])
+		bg = convoluted_exponential_log(t - t0, tau_bg, s) - np.log(convoluted_exponential_integral(shifted, tau_bg, s)[0])
+		# f_bg at either bound makes one of the logs -inf, which logaddexp handles
+		with np.errstate(divide='ignore'):
+			return np.logaddexp(np.log1p(-f_bg) + sig, np.log(f_bg) + bg)
+	return log_pdf
+
+
+lifetime_initial = {'tau': .4, 's': 1./7.5, 't0': 0., 'f_bg': .1, 'tau_bg': .2}
+lifetime_bounds = {'tau': (1e-3, None), 's': (1e-3, None), 'f_bg': (0, 1), 'tau_bg': (1e-3, None)}
+
+# fits the decay times with the resolution width and time offset floating as well as the lifetime
+# - fix any of them with fixed, e.g. fixed={'s': 1/7.5, 't0': 0} is the usual one parameter fit
+def fit_lifetime_model(times, weights, range=(0, 10), background=False, fixed={}, covariance='hessian'):
+	if background:
+		fit = UnbinnedFit(lifetime_bg_log_pdf(range), ['tau', 's', 't0', 'f_bg', 'tau_bg'], times, weights)
+	else:
+		fit = UnbinnedFit(lifetime_log_pdf(range), ['tau', 's', 't0'], times, weights)
+	return fit.fit(lifetime_initial, lifetime_bounds, fixed, covariance)
+
+
+# Extended unbinned fit in mass difference and decay time together, in place of the sideband weights.
+# - signal is signal_fit in dm times convoluted_exponential in t, background is background_fit in dm times a
+#   convoluted_exponential with its own lifetime tau_bg, both with the resolution width s
+# - n_sig and n_bg are the numbers of signal and background events in dm_range and t_range
+mass_time_names = ['n_sig', 'n_bg', 'm', 's1', 's2', 'f', 'p', 'bg_m', 'tau', 's', 'tau_bg']
+
+def mass_time_log_pdf(dm, t, n_sig, n_bg, m, s1, s2, f, p, bg_m, tau, s, tau_bg, dm_range=(139, 165), t_range=(0, 10)):
+	with np.errstate(divide='ignore'):
+		# the two gaussians as logs, so neither underflows in the far sidebands
+		sig_dm = np.logaddexp(np.log(f) - (dm-m)**2/(2*s1**2), np.log1p(-f) - (dm-m)**2/(2*s2**2)) \
+			- np.log(signal_integral(dm_range[0], dm_range[1], 1, m, s1, s2, f))
+		# background_fit is 0 below its kinematic limit bg_m
+		bg_dm = np.where(dm > bg_m, p*np.log(np.maximum(dm - bg_m, 1e-300)), -np.inf) - np.log(background_integral(dm_range[0], dm_range[1], 1, p, bg_m))
+		sig_t = convoluted_exponential_log(t, tau, s) - np.log(convoluted_exponential_integral(t_range, tau, s)[0])
+		bg_t = convoluted_exponential_log(t, tau_bg, s) - np.log(convoluted_exponential_integral(t_range, tau_bg, s)[0])
+		return np.logaddexp(np.log(n_sig) + sig_dm + sig_t, np.log(n_bg) + bg_dm + bg_t)
+
+def mass_time_expected(n_sig, n_bg, *shape):
+	return n_sig + n_bg
+
+mass_time_bounds = {'n_sig': (0, None), 'n_bg': (0, None), 's1': (1e-3, None), 's2': (1e-3, None), 'f': (0, 1), \
+	'p': (0, None), 'tau': (1e-3, None), 's': (1e-3, None), 'tau_bg': (1e-3, None)}
+
+# fits the mass differences (MeV) and decay times (ps) of the events in dm_range and t_range
+# - po is the combined_fit parameters of a mass difference fit, which the dm shape and the signal fraction start from
+# - fix e.g. fixed={'s': 1/7.5} to keep the resolution width, workers other than 1 spreads the NLL across a process pool
+# - the result has no f and s2 when the peak is fitted with one gaussian, see below
+def fit_mass_time(mass_diffs, times, po, dm_range=(139, 165), t_range=(0, 10), fixed={}, workers=1, covariance='hessian'):
+	keep = (dm_range[0] <= mass_diffs) & (mass_diffs <= dm_range[1]) & (t_range[0] <= times) & (times <= t_range[1])
+	mass_diffs, times = np.asarray(mass_diffs[keep], dtype=np.float64), np.asarray(times[keep], dtype=np.float64)
+
+	# the kinematic limit has to stay below every event for the background density to be positive
+	max_bg_m = np.min(mass_diffs)
+	sig, bg = signal_integral(dm_range[0], dm_range[1], *po[3:]), background_integral(dm_range[0], dm_range[1], *po[:3])
+	initial = {'n_sig': len(times)*sig/(sig + bg), 'n_bg': len(times)*bg/(sig + bg), \
+		'm': po[4], 's1': po[5], 's2': po[6], 'f': min(max(po[7], .01), .99), 'p': po[1], 'bg_m': min(po[2], max_bg_m - 1e-3), \
+		'tau': .4, 's': 1./7.5, 'tau_bg': .2}
+	bounds = dict(mass_time_bounds, bg_m=(None, max_bg_m))
+
+	log_pdf = functools.partial(mass_time_log_pdf, dm_range=dm_range, t_range=t_range)
+	fit = UnbinnedFit(log_pdf, mass_time_names, (mass_diffs, times), expected=mass_time_expected, workers=workers)
+	res = fit.fit(initial, bounds, fixed, covariance)
+
+	# f on 0 or 1 leaves one of the widths undetermined, and close widths leave f undetermined, the dm peak is
+	# then fitted with one gaussian, with f fixed at 1
+	values = dict(zip(res.names, res.values))
+	if 'f' in values and (values['f'] <= 0 or values['f'] >= 1 or not np.all(np.isfinite(res.errors))):
+		width = values.get('s2', fixed.get('s2')) if values['f'] <= 0 else values.get('s1', fixed.get('s1'))
+		print('fit_mass_time: degenerate double gaussian, f =', values['f'], 'refitting with one gaussian of width', width)
+		res = fit.fit(dict(initial, **dict(values, s1=width)), bounds, dict(fixed, f=1, s2=width), covariance)
+	return res
@@ -0,0 +1,243 @@
+import numpy as np
+import pylab as pl
+from matplotlib.colors import LogNorm
+from style import *
+from Background import *
+from Events import mass_toMeV
+from Resolution import resolution_models
+from Histogram import Histogram
+
+
+# The plot stage, everything that draws. The fits are drawn from the results the analysis records with add_result
+# and saves with save_results, so the figures can be redrawn without rerunning it:
+#     python Plots.py [--latex-plot] [--rerender]
+# The distributions of the events themselves are drawn by Cuts.py from its event tables, unless --no-plot.
+
+
+def massDiff_plot(res, ext_name='', range=(139, 165)):
+	hist, bin_edges, masses, po = res['hist'], res['bin_edges'], res['masses'], res['po']
+	fit = len(po) > 0
+	bin_width = bin_edges[1] - bin_edges[0]
+
+	# https://suchideas.com/articles/maths/applied/histogram-errors/
+	errors = np.sqrt(hist)
+
+	fig = newrawfig(width=.65)
+	margin = .16
+	out_margin = .02
+	subpl_height = .35
+	width, height = 1, 1
+	# x_l, x_b, w, h
+	ax = fig.add_axes([margin, subpl_height, width-margin-out_margin, height-subpl_height-margin/2])
+	ax.axes.get_xaxis().set_visible(False)
+	ax.plot(masses, hist, '.b')
+
+	if fit:
+		masses_continuous = np.arange(m_pi, masses[-1], .02)
+		ax.plot(masses_continuous, combined_fit(masses_continuous, *po), '-b')
+		ax.plot(masses_continuous, double_gaussian(masses_continuous, *po[3:]), '-k')
+		ax.fill_between(masses_continuous, 0, background_fit(masses_continuous, *po[:3]), facecolor='#C83C80', edgecolor="None")
+
+		pull_ax = fig.add_axes([margin, margin, width-margin-out_margin, subpl_height-margin])
+		pulls = (hist-combined_fit(masses, *po))/errors
+		pull_ax.bar(masses, pulls, bin_width, edgecolor="None")
+		pull_ax.set_xlim(range)
+# 		pull_ax.set_ylim(-5,5)
+
+		pull_ax.set_ylabel(r'Pull')
+		pull_ax.set_xlabel(r'$\Delta m$ [GeV/$c^2$]')
+
+		for tick in pull_ax.yaxis.get_major_ticks():
+			tick.label.set_fontsize(5 if is_latex else 6)
+
+		fig.set_tight_layout(True)
+	else:
+		ax.set_xlabel(r'$\Delta m$ [GeV/$c^2$]')
+
+	ax.set_xlim(range)
+	ax.set_ylabel(r'Decays / $%s$ GeV/$c^2$' % np.round(bin_width, 2))
+	savefig('cut-fitted'+ext_name)
+	pl.close()
+
+
+def plot_lifetime(res):
+	time, hist, hist_bg, errors, bin_edges = res['time'], res['hist'], res['hist_bg'], res['errors'], res['bin_edges']
+	tau_elimination, pdf_gaussian_width = res['tau'], res['pdf_gaussian_width']
+	time_range = (bin_edges[0], bin_edges[-1])
+
+	time_cont = np.linspace(time_range[0], time_range[1], 1000)
+	bin_width = np.round(bin_edges[1]-bin_edges[0], 2)
+
+	fig, ax = newfig()
+	pl.semilogy(time, hist, '.k')
+	pl.semilogy(time, hist_bg, marker='.', linestyle='None', color='#C83C80')
+	pl.errorbar(time, hist, yerr=errors, fmt=',k', capsize=0)
+	pl.semilogy(time_cont, convoluted_exponential(time_cont, max(hist)*.7, tau_elimination, pdf_gaussian_width), '-k')
+	ax.fill_between(time_cont, 1e-4, convoluted_exponential(time_cont, max(hist)*.7, tau_elimination, pdf_gaussian_width), facecolor='#F8E85E')
+	pl.xlabel(r'Decay time [ps]')
+	pl.ylabel(r'Number of decays / $' + str(bin_width) + '$ps')
+	ax.set_ylim(1e-4, 1.25e5 if is_latex else 1.2e5)
+	ax.set_xlim(time_range)
+	savefig('decay-fitted')
+	pl.close()
+
+	fig, ax = newfig()
+	pl.plot(time, hist, '.k')
+	pl.plot(time, hist_bg, marker='.', linestyle='None', color='#C83C80')
+	pl.errorbar(time, hist, yerr=errors, fmt=',k', capsize=0)
+	pl.plot(time_cont, convoluted_exponential(time_cont, max(hist)*.73, tau_elimination, pdf_gaussian_width), '-k')
+	ax.fill_between(time_cont, 1e-4, convoluted_exponential(time_cont, max(hist)*.73, tau_elimination, pdf_gaussian_width), facecolor='#F8E85E')
+	ax.set_xlim(time_range[0], 4)
+	ax.set_ylim(1e-4, 1.25e5 if is_latex else 1.2e5)
+	pl.xlabel(r'Decay time [ps]')
+	pl.ylabel(r'Number of decays / $' + str(bin_width) + '/,$ps')
+	savefig('decay')
+	pl.close()
+
+
+def plot_scan(res):
+	newfig(0.65 if is_latex else 2)
+	pl.plot(res['taus'], res['nll'])
+	pl.xlabel(r'$\tau$ [ps]')
+	pl.ylabel(r'$- \log{\mathcal{L}}$')
+	savefig('L vs tau')
+	pl.close()
+
+
+def plot_resolution(res):
+	time, hist, errors, po = res['time'], res['hist'], res['errors'], res['po']
+	newfig()
+	pl.semilogy(time, hist, '.g')
+	pl.errorbar(time, hist, yerr=errors, fmt=',g', capsize=0)
+	if len(po):
+		pl.semilogy(time, resolution_models[str(res['model'])](time, *po), '-g')
+	pl.xlabel(r'Decay time [ps]')
+	savefig('dstar-decay-time')
+	pl.close()
+
+	p_edges = res['p_edges']
+	fig, ax = newfig()
+	pl.errorbar((p_edges[1:] + p_edges[:-1])/2, res['widths'], yerr=res['width_errors'], xerr=np.diff(p_edges)/2, fmt='.k', capsize=0)
+	pl.xlabel(r'$D^{*+}$ transverse momentum $p_T$ [MeV / c]')
+	pl.ylabel(r'Resolution width [ps]')
+	savefig('resolution-momentum')
+	pl.close()
+
+
+# queues the plots of every result of load_results, see style.render_queued
+def plot_results(results):
+	for name, res in results.items():
+		if name.startswith('massDiff'):
+			queue_plot(massDiff_plot, res, name[len('massDiff'):])
+	if 'lifetime' in results:
+		queue_plot(plot_lifetime, results['lifetime'])
+	if 'scan' in results:
+		queue_plot(plot_scan, results['scan'])
+	if 'resolution' in results:
+		queue_plot(plot_resolution, results['resolution'])
+
+
+# Distributions of the events.
+
+# draws a Histogram as pl.hist would draw the values it was filled with
+def draw_histogram(hist, **kwargs):
+	return pl.hist(hist.edges[:-1], hist.edges, weights=hist.sumw, **kwargs)
+
+# the histograms plot_masses draws, of the mass difference against the D0 mass and of the D0 mass
+def mass_histograms(data):
+	bins = 150 if is_latex else 200
+	d0 = mass_toMeV(data.reconstructedD0Mass)/1000
+	return np.histogram2d(data.massDiff_d0dstar, d0, bins), Histogram.of(d0, bins)
+
+def plot_masses(hists):
+	(hist2d, md_edges, d0_edges), d0_hist = hists
+	fig, ax = newfig()
+	# as pl.hist2d draws it
+	pl.pcolormesh(md_edges, d0_edges, hist2d.T, norm=LogNorm())
+	pl.colorbar()
+	pl.xlabel(r'$\Delta m$ [MeV$/c^2$]')
+	pl.ylabel(r'$m_{D^0}$ [GeV$/c^2$]')
+	ax.set_xlim(139, 170)
+	ax.set_ylim(1.79, 1.94)
+	savefig_image('mass-diff-hist', directory='../report/' if is_latex else '')
+	pl.close()
+
+	fig, ax = newfig()
+	draw_histogram(d0_hist)
+	pl.xlabel(r'$m_{D^0}$ [GeV$/c^2$]')
+	# pl.ylabel(r'$m_{D^0}$ [GeV$/c^2$]')
+	ax.set_xlim(1.79, 1.94)
+	savefig('mass-d0-hist', directory='../report/' if is_latex else '')
+	pl.close()
+
+
+# the Histograms plotData draws, so the plot workers are sent the histograms rather than the events
+def data_histograms(data):
+	masses, ds_masses = mass_toMeV(data.reconstructedD0Mass), mass_toMeV(data.reconstructedDstarMass)
+	trav = Histogram(500, (0, 0.04))
+	trav.fill(data.labFrameTravel)
+	return {'masses': Histogram.of(masses), 'ds_masses': Histogram.of(ds_masses), 'mass_diffs': Histogram.of(ds_masses - masses), \
+		'gammas': Histogram.of(data.gamma, 500), 'trav': trav}
+
+def plotData(hists):
+	# mass dist
+	newfig()
+	draw_histogram(hists['masses'], histtype='step', fill=False)
+	pl.xlabel(r'$D^0$ Mass [MeV/$c^2$]')
+	savefig('mass-dist')
+	pl.close()
+
+	# dstar mass dist
+	newfig()
+	draw_histogram(hists['ds_masses'], histtype='step', fill=False)
+	pl.xlabel(r'$D^{+*}$ Mass [MeV/$c^2$]')
+	savefig('dstar-mass-dist')
+	pl.close()
+
+	# mass difference dist
+	newfig()
+	draw_histogram(hists['mass_diffs'], histtype='step', fill=False)
+	pl.xlabel(r'Mass difference [MeV/$c^2$]')
+	savefig('mass-diff-dist')
+	pl.close()
+
+	# gamma dist
+	newfig()
+	draw_histogram(hists['gammas'])
+	savefig('gamma-dist')
+	pl.close()
+
+	# travel dist
+	newfig()
+	draw_histogram(hists['trav'])
+	savefig('trav-dist')
+	pl.close()
+
+
+def plot_compare(accepted, rejected, prop, name, range=None, label=None):
+	diffs_a, diffs_r = getattr(accepted, prop), getattr(rejected, prop)
+	fig, ax = newfig()
+	pl.yscale('log')
+
+	acc = pl.hist(diffs_a, 100, facecolor='g', histtype='step', range=range, label='accepted')
+	rej = pl.hist(diffs_r, 100, facecolor='r', histtype='step', range=range, label='rejected')
+
+	if label:
+		pl.xlabel(label)
+	pl.ylabel(r'Relative frequency')
+	ax.legend(loc='upper right', shadow=False)
+	savefig(name+'-compare')
+	pl.close()
+
+
+# hist is the Histogram of the events' pPslow
+def plot_offsets(hist):
+	newfig()
+	draw_histogram(hist, histtype='step', fill=False)
+	savefig('offsets')
+	pl.close()
+
+
+if __name__ == '__main__':
+	plot_results(load_results())
+	render_queued(skip_unchanged=not '--rerender' in sys.argv)
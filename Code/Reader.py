@@ -0,0 +1,219 @@
+from typing import Text
+import hashlib
+import json
+import os
+import numpy as np
+from Events import EventTable
+
+# order of the 3-vector columns passed to EventTable
+order = ['Dstar_OWNPV', 'Dstar_ENDVERTEX', 'D_ENDVERTEX', 'B_ENDVERTEX', 'K', 'Pd', 'Ps']
+
+# bytes of text parsed at a time, big enough that numpy does all the work
+chunk_bytes = 1 << 24
+
+
+# reads the header line and returns the col titles, and the index of each vector in order within a row
+def read_header(path: Text):
+	with open(path, 'rb') as f:
+		header = f.readline().decode().split()
+
+	# ignore the coordinate, remove the last '_X'/'_PX' part in the header name
+	header_raw_names = ['_'.join(name.split('_')[:-1]) for name in header[::3]]
+	# get the indicies of these params in the row
+	elementIdxs = [header_raw_names.index(x) for x in order]
+	return header, elementIdxs
+
+
+def count_rows(path: Text):
+	rows, last = 0, b''
+	with open(path, 'rb') as f:
+		f.readline()
+		for block in iter(lambda: f.read(chunk_bytes), b''):
+			rows += block.count(b'\n')
+			last = block
+	# a last line without a newline
+	if last and not last.endswith(b'\n'):
+		rows += 1
+	return rows
+
+
+# yields (rows, cols) float64 blocks of the file body, each covering whole lines
+def read_blocks(path: Text, num_cols):
+	with open(path, 'rb') as f:
+		f.readline()
+		tail = b''
+		while True:
+			block = f.read(chunk_bytes)
+			if not block:
+				break
+			# only parse up to the last full line, keep the rest for the next block
+			end = block.rfind(b'\n')
+			if end == -1:
+				tail += block
+				continue
+			text, tail = tail + block[:end+1], block[end+1:]
+			yield parse_block(text, num_cols)
+
+		if tail.strip():
+			yield parse_block(tail, num_cols)
+
+
+def parse_block(text, num_cols):
+	# whitespace separated, so newlines split values the same way spaces do
+	nums = np.fromstring(text, sep=' ')
+	num_rows = text.count(b'\n') + (0 if text.endswith(b'\n') else 1)
+	if len(nums) != num_rows*num_cols:
+		raise ValueError('malformed data block, expected %d values per row' % num_cols)
+	return nums.reshape(-1, num_cols)
+
+
+# reads a space delimited candidate file straight into an EventTable
+# - the vector columns are allocated once at their final size and filled a block at a time, so peak memory
+#   stays close to the size of the table
+def read_events(path: Text):
+	num_rows = count_rows(path)
+	# the trailing scalar Dstar_FD column is skipped, scalars don't fit the 3-vectors
+	columns = [np.empty((num_rows, 3)) for _ in order]
+	fill_columns(path, columns)
+	return EventTable(*columns)
+
+# fills (num rows, 3) arrays in order with the vectors in the file, a block at a time
+def fill_columns(path: Text, columns):
+	header, elementIdxs = read_header(path)
+	num_rows = len(columns[0])
+
+	row = 0
+	for block in read_blocks(path, len(header)):
+		for col, idx in zip(columns, elementIdxs):
+			col[row:row+len(block)] = block[:, 3*idx:3*idx+3]
+		row += len(block)
+
+	if row != num_rows:
+		raise ValueError('expected %d rows in %s, read %d' % (num_rows, path, row))
+
+
+# binary cache of a parsed file, kept next to it in '<name>.cache/'
+# - one .npy per vector column, reopened memory-mapped so loading doesn't touch the text file at all
+# - key.json records the size, mtime and hash of the source; it is written last so a partial cache is never used
+
+def cache_dir(path: Text):
+	return path + '.cache'
+
+def file_hash(path: Text):
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(chunk_bytes), b''):
+			h.update(block)
+	return h.hexdigest()
+
+def source_key(path: Text, digest=None):
+	st = os.stat(path)
+	return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'hash': digest or file_hash(path)}
+
+
+# returns True if the cache for path is still valid
+# - size and mtime matching is trusted, if only the mtime moved the file is rehashed, so touching
+#   (or re-checking out) an unchanged file keeps its cache
+def cache_is_fresh(path: Text):
+	try:
+		with open(os.path.join(cache_dir(path), 'key.json')) as f:
+			key = json.load(f)
+	except (OSError, ValueError):
+		return False
+
+	st = os.stat(path)
+	if key['size'] != st.st_size:
+		return False
+	if key['mtime'] == st.st_mtime_ns:
+		return True
+	if key['hash'] != file_hash(path):
+		return False
+
+	write_key(path, key['hash'])
+	return True
+
+def write_key(path: Text, digest=None):
+	with open(os.path.join(cache_dir(path), 'key.json'), 'w') as f:
+		json.dump(source_key(path, digest), f)
+
+
+# parses path straight into memory-mapped .npy files, so the text never has to fit in memory
+def write_cache(path: Text):
+	directory = cache_dir(path)
+	os.makedirs(directory, exist_ok=True)
+	# invalidate first, so a crash part way through leaves no key
+	if os.path.exists(os.path.join(directory, 'key.json')):
+		os.remove(os.path.join(directory, 'key.json'))
+
+	num_rows = count_rows(path)
+	# EventTable.vectors is the same column order as Reader.order
+	columns = [np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', shape=(num_rows, 3)) for name in EventTable.vectors]
+	fill_columns(path, columns)
+	for col in columns:
+		col.flush()
+	del columns
+	write_key(path)
+
+def read_cache(path: Text, mmap_mode='r'):
+	directory = cache_dir(path)
+	return EventTable(*[np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in EventTable.vectors])
+
+
+# reads the candidates in path, through the binary cache
+# - parses the text and fills the cache the first time, or when the file has changed since
+def load_events(path: Text, use_cache=True):
+	if not use_cache:
+		return read_events(path)
+
+	if not cache_is_fresh(path):
+		write_cache(path)
+	return read_cache(path)
+
+
+# yields the candidates in path as EventTables of at most chunk_rows events
+# - only one chunk (and its derived columns) is held at a time, so memory stays bounded however big the file is
+def iter_events(path: Text, chunk_rows=1 << 20, use_cache=True):
+	if use_cache:
+		events = load_events(path)
+		for start in range(0, len(events), chunk_rows):
+			yield events[start:start+chunk_rows]
+		return
+
+	header, elementIdxs = read_header(path)
+	pending, num_pending = [], 0
+	for block in read_blocks(path, len(header)):
+		pending.append(block)
+		num_pending += len(block)
+		while num_pending >= chunk_rows:
+			rows = np.concatenate(pending)
+			yield EventTable(*[rows[:chunk_rows, 3*idx:3*idx+3] for idx in elementIdxs])
+			pending, num_pending = [rows[chunk_rows:]], num_pending - chunk_rows
+
+	if num_pending:
+		rows = np.concatenate(pending)
+		yield EventTable(*[rows[:, 3*idx:3*idx+3] for idx in elementIdxs])
+
+
+# Snapshot of an EventTable for later scripts, a directory with one .npy per column.
+# - the vectors and any derived columns named in columns, all plain numeric arrays
+# - read_snapshot memory-maps them, derived columns are set as the table's cached properties so they aren't recomputed
+# - meta.json lists the columns, it is written last so a partial snapshot is never read
+
+def write_snapshot(events, directory: Text, columns=()):
+	os.makedirs(directory, exist_ok=True)
+	if os.path.exists(os.path.join(directory, 'meta.json')):
+		os.remove(os.path.join(directory, 'meta.json'))
+
+	for name in list(EventTable.vectors) + list(columns):
+		np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(getattr(events, name)))
+	with open(os.path.join(directory, 'meta.json'), 'w') as f:
+		json.dump({'num_events': len(events), 'columns': list(columns)}, f)
+
+def read_snapshot(directory: Text, mmap_mode='r'):
+	with open(os.path.join(directory, 'meta.json')) as f:
+		meta = json.load(f)
+	events = EventTable(*[np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in EventTable.vectors])
+	for name in meta['columns']:
+		# where lazy_property keeps the value of the property name
+		setattr(events, '_' + name, np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode))
+	return events
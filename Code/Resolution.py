@@ -1,36 +1,113 @@
-from Lifetime import *
+import numpy as np
+import scipy.optimize as spo
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from Background import *
+from Histogram import Histogram
 
-# print(times)
 
-_data = np.load('fitting_FULLSET.npy')
+# Decay time resolution from the D* decay times. The D* decays at the B vertex, so its measured decay time is
+# the resolution alone, with the background subtracted by weighting the sidebands by wb as in the lifetime fit.
+# The fitted width can replace Fitting.pdf_gaussian_width in the lifetime fit, see Cuts.py --fit-resolution.
+#     python Resolution.py [double]
+# fits the events of the last Cuts.py run, from fitting_FULLSET/ and fit-results.npz
 
-data = [d for d in _data]
+# width: standard deviation of the model, for 'double' that of the two gaussians together, nan if the fit failed
+ResolutionFit = namedtuple('ResolutionFit', ['width', 'error', 'po'])
 
-wb = -0.2939171976029101
-range_low, range_up = 142.414041989, 149.059198523
+resolution_models = {'single': gaussian, 'double': double_gaussian}
 
-times = [d.dStarDecayTime*1e12 for d in data]
-weights = [(1 if range_low <= d.massDiff_d0dstar <= range_up else wb) for d in data]
 
-time_range, bin_num = (-2, 0), 120
+# weighted decay time Histograms, one for each momentum bin between p_edges
+def resolution_histograms(times, momenta, weights, p_edges, time_range=(-2, 0), bin_num=120):
+	# the last bin includes the upper edge, as in np.histogram
+	p_bin = np.clip(np.searchsorted(p_edges, momenta, side='right') - 1, 0, len(p_edges)-2)
+	hists = []
+	for i in range(len(p_edges)-1):
+		in_bin = p_bin == i
+		hist = Histogram(bin_num, time_range)
+		hist.fill(times[in_bin], weights[in_bin])
+		hists.append(hist)
+	return hists
 
-# decay time curve
-hist, bin_edges = np.histogram(times, bins=bin_num, range=time_range, weights=weights)
-hist_unw, _ = np.histogram(times, bins=bin_num, range=time_range)
+def fit_resolution_model(time, hist, sumw2, model='single'):
+	filled = sumw2 > 0
+	time, hist, errors = time[filled], hist[filled], np.sqrt(sumw2[filled])
+	if len(time) < 6:
+		return ResolutionFit(np.nan, np.nan, [])
+	s = np.sqrt(np.sum(np.abs(hist)*time**2)/np.sum(np.abs(hist)))
 
-sy = np.histogram(times, bins=bin_edges, weights=times)[0]
-time = bin_edges[:-1]
-# errors = [x*.9999999999 if x <= 1 else np.sqrt(x) for x in hist-.0000000001]
+	try:
+		if model == 'double':
+			po, cov = spo.curve_fit(double_gaussian, time, hist, [max(hist), 0, s, 2*s, .7], errors, \
+				bounds=([0, -np.inf, 0, 0, 0], [np.inf, np.inf, np.inf, np.inf, 1]))
+		else:
+			po, cov = spo.curve_fit(gaussian, time, hist, [max(hist), s, 0], errors)
+	except (RuntimeError, ValueError):
+		return ResolutionFit(np.nan, np.nan, [])
+	# curve_fit gives an infinite covariance, with an OptimizeWarning, when it can't estimate it
+	if not (np.all(np.isfinite(po)) and np.all(np.isfinite(cov))):
+		return ResolutionFit(np.nan, np.nan, [])
 
-po_conv, po_cov_conv = spo.curve_fit(gaussian, time, hist, [1000, .8, 0])#, errors, absolute_sigma=True)
+	if model == 'double':
+		_, _, s1, s2, f = po
+		# f is the fraction of the peak height, the gaussians' areas are in the ratio f s1 : (1-f) s2
+		N, D = f*s1**3 + (1-f)*s2**3, f*s1 + (1-f)*s2
+		width = np.sqrt(N/D)
+		# d width / d (s1, s2, f), from d(N/D) = (dN D - N dD)/D^2
+		dV = np.array([3*f*s1**2*D - N*f, 3*(1-f)*s2**2*D - N*(1-f), (s1**3 - s2**3)*D - N*(s1 - s2)])/D**2
+		J = dV/(2*width)
+		error = np.sqrt(J @ cov[2:, 2:] @ J)
+	else:
+		width, error = np.abs(po[1]), np.sqrt(cov[1, 1])
+	# a width without a finite, non zero error is as good as no fit, a model through every point has an error
+	# of rounding size
+	if not (np.isfinite(width) and np.isfinite(error) and error > 1e-9*width):
+		return ResolutionFit(np.nan, np.nan, [])
+	return ResolutionFit(width, error, po)
 
-newfig()
-pl.semilogy(time, hist, '.g')
-pl.semilogy(time, gaussian(time, *po_conv), '-g')
-pl.semilogy(time, hist_unw, '.b')
-pl.xlabel(r'Decay time [ps]')
-savefig('dstar-decay-time')
-pl.close()
 
-print(np.mean(times), np.std(times), po_conv)
+# fits the resolution over all the events and in num_p_bins bins of D* transverse momentum with equal numbers of
+# events, the fits run across a process pool
+# - wb and the signal range are those of the lifetime fit, see SidebandModel
+# - records the fits for plot_resolution and returns the width of the fit to all of them, in ps
+def fit_resolution(events, wb, range_low, range_up, model='single', time_range=(-2, 0), bin_num=120, num_p_bins=5, workers=None):
+	times = events.dStarDecayTime*1e12
+	mass_diffs = events.massDiff_d0dstar
+	weights = np.where((range_low <= mass_diffs) & (mass_diffs <= range_up), 1, wb)
+	momenta = events.pDstar_t
 
+	p_edges = np.quantile(momenta, np.linspace(0, 1, num_p_bins+1))
+	hists = resolution_histograms(times, momenta, weights, p_edges, time_range, bin_num)
+	total = hists[0].copy()
+	for h in hists[1:]:
+		total.merge(h)
+	time = (total.edges[1:] + total.edges[:-1])/2
+	# the first row is all the events
+	hist, sumw2 = np.array([h.sumw for h in [total] + hists]), np.array([h.sumw2 for h in [total] + hists])
+
+	with ProcessPoolExecutor(workers) as pool:
+		fits = list(pool.map(fit_resolution_model, [time]*len(hist), hist, sumw2, [model]*len(hist)))
+
+	res = fits[0]
+	if not np.isfinite(res.width):
+		raise ValueError('resolution fit to all the events failed, check time_range')
+	print('resolution', res.width, '+-', res.error, 'ps', [f.width for f in fits[1:]])
+	add_result('resolution', time=time, hist=hist[0], errors=np.sqrt(sumw2[0]), po=res.po, model=model, \
+		p_edges=p_edges, widths=[f.width for f in fits[1:]], width_errors=[f.error for f in fits[1:]])
+	add_val('resolution_width', res.width*1e3)
+	add_val('resolution_error', res.error*1e3)
+	return res.width
+
+
+if __name__ == '__main__':
+	import sys
+	from Reader import read_snapshot
+	from Plots import plot_resolution, queue_plot, render_queued
+
+	# the events maximum_likelyhood_exp_fit was given, memory-mapped
+	data = read_snapshot('fitting_FULLSET')
+	lifetime = load_results()['lifetime']
+	fit_resolution(data, lifetime['wb'], lifetime['range_low'], lifetime['range_up'], 'double' if 'double' in sys.argv else 'single')
+	queue_plot(plot_resolution, result_list['resolution'])
+	render_queued()
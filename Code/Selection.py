@@ -0,0 +1,83 @@
+import time
+import numpy as np
+from collections import namedtuple
+
+
+# keeps the events with low <= column <= high, either side can be None for no limit
+# - veto keeps the events outside the range instead
+# - column is any EventTable property, e.g. Cut('pD0_t', 2500) or Cut('d0IP_log', -5, -2.5)
+Cut = namedtuple('Cut', ['column', 'low', 'high', 'veto'], defaults=(None, None, False))
+
+# passed: events left after this and all earlier cuts
+# efficiency: fraction of all events this cut keeps on its own, marginal_efficiency: fraction of those left by the
+# earlier cuts that it keeps, seconds: time to compute the column and its mask
+CutReport = namedtuple('CutReport', ['cut', 'passed', 'efficiency', 'marginal_efficiency', 'seconds'])
+
+
+def cut_mask(events, cut: Cut):
+	col = getattr(events, cut.column)
+	mask = np.ones(len(col), dtype=bool)
+	if cut.low is not None:
+		mask &= cut.low <= col
+	if cut.high is not None:
+		mask &= col <= cut.high
+	return ~mask if cut.veto else mask
+
+
+# Applies a list of cuts to an EventTable as boolean masks over its columns, no events are copied.
+# The mask of each cut is kept as a packed bitmap (1 bit per event), so the accepted and rejected sets at any
+# point in the chain can be recovered without holding a copy of the events for each.
+class Selection(object):
+
+	def __init__(self, events, cuts):
+		self.num_events = len(events)
+		self.cuts = list(cuts)
+		self.bits = []
+		self.reports = []
+
+		accepted = np.ones(self.num_events, dtype=bool)
+		for cut in self.cuts:
+			start = time.perf_counter()
+			mask = cut_mask(events, cut)
+			seconds = time.perf_counter() - start
+
+			before = np.count_nonzero(accepted)
+			accepted &= mask
+			passed = np.count_nonzero(accepted)
+			self.bits.append(np.packbits(mask))
+			self.reports.append(CutReport(cut, passed, np.count_nonzero(mask)/max(self.num_events, 1), passed/max(before, 1), seconds))
+
+		self.accepted_bits = np.packbits(accepted)
+
+	def unpack(self, bits):
+		return np.unpackbits(bits, count=self.num_events).astype(bool)
+
+	# events passing all cuts, or only the first upto of them
+	def mask(self, upto=None):
+		if upto is None:
+			return self.unpack(self.accepted_bits)
+		mask = np.ones(self.num_events, dtype=bool)
+		for bits in self.bits[:upto]:
+			mask &= self.unpack(bits)
+		return mask
+
+	# events passing cut i on its own
+	def cut_mask(self, i):
+		return self.unpack(self.bits[i])
+
+	def accepted(self, events):
+		return events[self.mask()]
+
+	def rejected(self, events):
+		return events[~self.mask()]
+
+	# events that passed the cuts before cut i and failed it
+	def rejected_by(self, i, events):
+		return events[self.mask(i) & ~self.cut_mask(i)]
+
+	def print_report(self):
+		print('cut', '\t\tpassed', '\tefficiency', '\tmarginal', '\tms')
+		for r in self.reports:
+			c = r.cut
+			limits = '%s%s <= %s <= %s' % ('veto ' if c.veto else '', c.low, c.column, c.high)
+			print(limits, '\t%d' % r.passed, '\t%.4f' % r.efficiency, '\t%.4f' % r.marginal_efficiency, '\t%.2f' % (r.seconds*1e3))
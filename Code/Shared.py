@@ -0,0 +1,54 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# Copies named arrays into shared memory blocks once, so worker processes can read them without every task
+# pickling the data. spec is small and picklable, pass it to the workers and open it there with attach_arrays.
+class SharedArrays(object):
+
+	def __init__(self, arrays):
+		self.blocks = []
+		self.spec = {}
+		for name, a in arrays.items():
+			a = np.ascontiguousarray(a)
+			block = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+			np.ndarray(a.shape, a.dtype, buffer=block.buf)[...] = a
+			self.blocks.append(block)
+			self.spec[name] = (block.name, a.shape, a.dtype.str)
+
+	def close(self):
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+		self.blocks = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+# worker side of SharedArrays, returns name -> read only array, and the blocks which must be kept open while
+# the arrays are used
+# - workers are children of the creating process and share its resource tracker, so the blocks are only
+#   unlinked once, by SharedArrays.close
+def attach_arrays(spec):
+	arrays, blocks = {}, []
+	for name, (block_name, shape, dtype) in spec.items():
+		block = shared_memory.SharedMemory(name=block_name)
+		a = np.ndarray(shape, dtype, buffer=block.buf)
+		a.flags.writeable = False
+		arrays[name] = a
+		blocks.append(block)
+	return arrays, blocks
+
+
+# per worker process state of a process pool, set once by init_worker and read by the module level task functions
+worker = {}
+
+# pool initializer, e.g. ProcessPoolExecutor(initializer=init_worker, initargs=(shared.spec, {'scan': scan}))
+# - the arrays of spec go in worker['arrays'], and the rest of the state as it is
+def init_worker(spec, state={}):
+	worker['arrays'], worker['blocks'] = attach_arrays(spec)
+	worker.update(state)
@@ -0,0 +1,157 @@
+import os
+import hashlib
+import inspect
+import pickle
+import weakref
+import numpy as np
+from Background import write_list, result_list
+from Events import EventTable
+from Shared import worker
+
+
+# Content addressed cache of the pipeline's stages, kept in '.stage-cache/'.
+# - a stage is a function call, its key hashes the function's name and source with the content of its arguments,
+#   so a stage only reruns when its code, its input events or its settings change
+# - the code is that of the function and of every function and class of the analysis it uses, directly or through
+#   others, with their default arguments and the module level settings they read, e.g. Lifetime.time_bins or
+#   Likelihood.mass_time_bounds, and that of EventTable, which works out the columns of the events it is given
+# - the data.txt records and fit results it adds are saved with what it returns and added again when it is loaded
+
+stage_dir = '.stage-cache'
+code_dir = os.path.dirname(os.path.abspath(__file__))
+
+# module level values that are hashed as settings, with what they hold, anything else global is left out
+setting_types = (bool, int, float, complex, str, bytes, tuple, list, dict, set, frozenset, np.ndarray, type(None), np.number)
+# module level state that changes as the pipeline runs, which isn't a setting, other modules add theirs to it
+run_state = [write_list, result_list, worker]
+
+# EventTables are hashed once, a table's hash is dropped with it
+table_hashes = weakref.WeakKeyDictionary()
+
+def update_hash(h, value):
+	if isinstance(value, EventTable):
+		if value not in table_hashes:
+			th = hashlib.sha1()
+			for name in EventTable.vectors:
+				update_hash(th, getattr(value, name))
+			table_hashes[value] = th.hexdigest()
+		h.update(table_hashes[value].encode())
+	elif isinstance(value, np.ndarray):
+		h.update(('%s %s' % (value.dtype.str, value.shape)).encode())
+		h.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8).data)
+	elif isinstance(value, (list, tuple)):
+		h.update(('%s %d' % (type(value).__name__, len(value))).encode())
+		for v in value:
+			update_hash(h, v)
+	elif isinstance(value, dict):
+		update_hash(h, sorted(value.items()))
+	else:
+		h.update(repr(value).encode())
+
+# functions and classes defined in the analysis' own modules
+def is_analysis_code(obj):
+	if not (inspect.isfunction(obj) or inspect.isclass(obj)):
+		return False
+	try:
+		return os.path.dirname(os.path.abspath(inspect.getsourcefile(obj))) == code_dir
+	except TypeError:
+		return False
+
+# names a code object and the functions nested in it read
+def code_names(code):
+	names = set(code.co_names)
+	for const in code.co_consts:
+		if inspect.iscode(const):
+			names |= code_names(const)
+	return names
+
+# hashes a module level setting, following the analysis code it holds, e.g. the pdfs of Background.analytic_integrals
+def update_setting_hash(h, value, seen):
+	value = inspect.unwrap(value) if callable(value) else value
+	if is_analysis_code(value):
+		update_code_hash(h, value, seen)
+	elif isinstance(value, dict):
+		h.update(('dict %d' % len(value)).encode())
+		for k, v in value.items():
+			update_setting_hash(h, k, seen)
+			update_setting_hash(h, v, seen)
+	elif isinstance(value, (list, tuple, set, frozenset)):
+		h.update(('%s %d' % (type(value).__name__, len(value))).encode())
+		for v in (sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value):
+			update_setting_hash(h, v, seen)
+	elif callable(value):
+		# e.g. numpy and scipy functions, their repr holds an address which changes from run to run
+		h.update(('%s.%s' % (getattr(value, '__module__', None), getattr(value, '__qualname__', None))).encode())
+	else:
+		update_hash(h, value)
+
+# hashes the source of obj, and of the analysis code and the settings it uses, once each
+def update_code_hash(h, obj, seen):
+	if obj in seen:
+		return
+	seen.add(obj)
+	try:
+		h.update(inspect.getsource(obj).encode())
+	except OSError:
+		# classes made at run time have no source, e.g. namedtuples, their fields stand in for it
+		update_hash(h, (obj.__qualname__, getattr(obj, '_fields', None)))
+
+	if inspect.isclass(obj):
+		for value in vars(obj).values():
+			# methods, static and class methods, properties and LazyProperty
+			func = getattr(value, '__func__', None) or getattr(value, '__wrapped__', None) or getattr(value, 'fget', None) or value
+			if inspect.isfunction(func):
+				update_code_hash(h, func, seen)
+		return
+
+	update_hash(h, [obj.__defaults__, obj.__kwdefaults__])
+	for name in sorted(code_names(obj.__code__)):
+		if name not in obj.__globals__:
+			continue
+		# e.g. functools.lru_cache wrappers
+		value = inspect.unwrap(obj.__globals__[name])
+		if any(value is state for state in run_state):
+			continue
+		if is_analysis_code(value):
+			update_code_hash(h, value, seen)
+		elif isinstance(value, setting_types):
+			h.update(name.encode())
+			update_setting_hash(h, value, seen)
+
+def stage_key(name, func, args, kwargs, depends):
+	h = hashlib.sha1()
+	h.update(('%s %s.%s' % (name, func.__module__, func.__qualname__)).encode())
+	seen = set()
+	update_code_hash(h, func, seen)
+	update_code_hash(h, EventTable, seen)
+	for value in (args, kwargs, depends):
+		update_hash(h, value)
+	return h.hexdigest()
+
+
+# returns func(*args, **kwargs), or what it returned the last time it ran on the same inputs
+# - depends is anything else the result depends on that isn't an argument, e.g. Fitting.fit_range
+def run_stage(name, func, *args, depends=(), use_cache=True, **kwargs):
+	if not use_cache:
+		return func(*args, **kwargs)
+
+	path = os.path.join(stage_dir, '%s-%s.pkl' % (name, stage_key(name, func, args, kwargs, depends)))
+	if os.path.exists(path):
+		print('stage', name, 'cached')
+		with open(path, 'rb') as f:
+			out, records, results = pickle.load(f)
+		write_list.extend(records)
+		result_list.update(results)
+		return out
+
+	num_records, results_before = len(write_list), dict(result_list)
+	out = func(*args, **kwargs)
+	records = write_list[num_records:]
+	results = {k: v for k, v in result_list.items() if results_before.get(k) is not v}
+
+	os.makedirs(stage_dir, exist_ok=True)
+	# written under a temporary name and moved into place, so a crash never leaves a partial entry
+	with open(path + '.tmp', 'wb') as f:
+		pickle.dump((out, records, results), f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(path + '.tmp', path)
+	return out
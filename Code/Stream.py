@@ -0,0 +1,111 @@
+from typing import Text
+import numpy as np
+from Background import *
+from Events import mass_toMeV
+from Fitting import fit_range, fit_lifetime, pdf_gaussian_width
+from Histogram import Histogram, data_range
+from Lifetime import decay_time_histograms, add_lifetime_result, fit_massDiff_histogram, max_dm, massDiff_bins
+from Reader import iter_events
+
+
+# Streaming version of the Cuts.py flow, candidates are read chunk_rows at a time and reduced to histograms so
+# memory stays bounded however many events there are.
+# - pass 1 finds the range of the mass differences before and after the D0/D* mass window
+# - pass 2 fills the mass difference histograms over those ranges, in the bins massDiff_fit puts the events in
+#   when they are all read at once, and the fits to them give the signal range
+# - pass 3 fills fine decay time histograms of the signal region and the sidebands, their bin centroids and
+#   weights stand in for the events in the lifetime fit, and the decay time histograms plot_lifetime draws
+# - the fine histograms stop at the end of the fit range, fit_range[1] ps, so they have a bounded number of bins,
+#   the few events after it are kept as they are, with their weights, and fitted with the bins
+# The mass difference fits are those of Cuts.py but for the last digits of the bin centroids, which are summed a
+# chunk at a time. The lifetime is fitted to the fine decay time bins rather than the events, and differs slightly.
+
+time_bin_width = 1e-3 # ps
+
+
+# mask of the events within meson_mass_width of the D0 and D* masses
+def mass_window(events, d0_c=1865., dstar_c=2010., meson_mass_width=30.):
+	d0_mass, dstar_mass = mass_toMeV(events.reconstructedD0Mass), mass_toMeV(events.reconstructedDstarMass)
+	return ((d0_c - meson_mass_width) <= d0_mass) & (d0_mass <= (d0_c + meson_mass_width)) & \
+		((dstar_c - meson_mass_width) <= dstar_mass) & (dstar_mass <= (dstar_c + meson_mass_width))
+
+# mask of the events maximum_likelyhood_exp_fit keeps
+def in_fit_range(events):
+	return (fit_range[0] <= events.decayTime*1e-12) & (events.decayTime*1e-12 <= fit_range[1])
+
+
+def stream_cuts(path: Text, width=3., meson_mass_width=30., chunk_rows=1 << 20):
+	before_range, after_range = [np.inf, -np.inf], [np.inf, -np.inf]
+	num_before, num_after, max_time = 0, 0, time_bin_width
+
+	for chunk in iter_events(path, chunk_rows):
+		dm = chunk.massDiff_d0dstar
+		window = mass_window(chunk, meson_mass_width=meson_mass_width)
+		for r, diffs in ((before_range, dm[dm < max_dm]), (after_range, dm[window & (dm < max_dm)])):
+			if len(diffs):
+				r[:] = min(r[0], np.min(diffs)), max(r[1], np.max(diffs))
+
+		num_before += len(chunk)
+		num_after += np.count_nonzero(window)
+		times = chunk.decayTime[window & in_fit_range(chunk)]*1e12
+		if len(times):
+			max_time = max(max_time, np.max(times))
+
+	dm_before = Histogram(massDiff_bins, data_range(*before_range))
+	dm_after = Histogram(massDiff_bins, data_range(*after_range))
+	for chunk in iter_events(path, chunk_rows):
+		dm = chunk.massDiff_d0dstar
+		dm_before.fill(dm)
+		dm_after.fill(dm[mass_window(chunk, meson_mass_width=meson_mass_width)])
+
+	po_fullset, bin_width = fit_massDiff_histogram(dm_before)
+	bg_integral, sig_integral, bg_fraction = estimate_background(po_fullset, num_before, bin_width, width)
+	add_int('bg_integral_before', bg_integral)
+	add_int('sig_integral_before', sig_integral)
+	add_val('bg_fraction_before', bg_fraction*100)
+	add_int('num_events_before', num_before)
+
+	after_po, after_bin_width = fit_massDiff_histogram(dm_after, 'after', bg_ratio=.01)
+	add_int('num_events', num_after)
+	sidebands = SidebandModel(after_po, width)
+	range_low, range_up, wb = sidebands.range_low, sidebands.range_up, sidebands.wb
+
+	time_range = (fit_range[0], min(max_time, fit_range[1]))
+	num_time_bins = int(np.ceil((time_range[1] - time_range[0])/time_bin_width))
+	t_signal, t_sidebands = Histogram(num_time_bins, time_range), Histogram(num_time_bins, time_range)
+	decay, decay_bg = None, None
+	overflow_times, overflow_weights = [], []
+
+	for chunk in iter_events(path, chunk_rows):
+		chunk = chunk[mass_window(chunk, meson_mass_width=meson_mass_width)]
+		chunk_decay, chunk_bg = decay_time_histograms(chunk.decayTime*1e12, chunk.massDiff_d0dstar, sidebands)
+		decay, decay_bg = (chunk_decay, chunk_bg) if decay is None else (decay.merge(chunk_decay), decay_bg.merge(chunk_bg))
+		chunk = chunk[in_fit_range(chunk)]
+		in_signal = sidebands.in_signal(chunk.massDiff_d0dstar)
+		times = chunk.decayTime*1e12
+		t_signal.fill(times[in_signal])
+		t_sidebands.fill(times[~in_signal])
+		over = times > time_range[1]
+		overflow_times.append(times[over])
+		overflow_weights.append(sidebands.weights(chunk.massDiff_d0dstar[over]))
+
+	sidebands.print_weights()
+	signal_bins, sideband_bins = t_signal.counts > 0, t_sidebands.counts > 0
+	times = np.concatenate([t_signal.centroids[signal_bins], t_sidebands.centroids[sideband_bins]] + overflow_times)
+	weights = np.concatenate([t_signal.counts[signal_bins], wb*t_sidebands.counts[sideband_bins]] + overflow_weights)
+	print('decay times after the fine histograms', sum(len(t) for t in overflow_times))
+	tau, tau_err, A, (taus, nll) = fit_lifetime(times, weights)
+	add_lifetime_result(decay, decay_bg, tau, pdf_gaussian_width, sidebands)
+	add_result('scan', taus=taus, nll=nll)
+
+	bg_integral, sig_integral, bg_fraction = estimate_background(after_po, num_after, after_bin_width, width)
+	add_val('lifetime_bgreduction', tau*1e3)
+	add_val('error_bgreduction', tau_err*1e3)
+	add_val('wb', wb, 3)
+	add_val('range_low', range_low)
+	add_val('range_up', range_up)
+	add_int('bg_integral', bg_integral)
+	add_int('sig_integral', sig_integral)
+	add_val('bg_fraction', bg_fraction*100)
+
+	return po_fullset, after_po, tau, tau_err, wb
@@ -0,0 +1,89 @@
+import time
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from Background import *
+from Fitting import fit_range, pdf_gaussian_width, fit_lifetime
+from Shared import SharedArrays, worker, init_worker
+
+
+# Toy Monte Carlo and bootstrap studies of the sideband weighted lifetime fit, for its bias and coverage.
+# - 'generate' toys draw mass differences from the combined_fit model and decay times from convoluted_exponential
+# - 'bootstrap' toys resample the real (times, mass_diffs) with replacement
+# Each toy is fitted the way maximum_likelyhood_exp_fit fits the data, with fit_lifetime and its error from the
+# likelihood scan, across a process pool. The real arrays are put in shared memory once and the workers attach to
+# them, so tasks only carry a seed.
+
+ToyResults = namedtuple('ToyResults', ['taus', 'errors', 'pulls', 'seconds', 'tau_true'])
+
+
+# cumulative trapezium integral of pdf over grid
+def cumulative(pdf, grid):
+	return np.concatenate([[0], np.cumsum((pdf[1:] + pdf[:-1])/2 * np.diff(grid))])
+
+# a pseudo data set of (times in ps, mass diffs in MeV), signal and background in the proportions of the po fit
+# - mass diffs are drawn by inverting the cumulative integrals of signal_fit and background_fit on a fine grid
+def generate_toy(rng, num_events, po, tau, s, tau_bg, max_dm=165):
+	grid = np.linspace(po[2], max_dm, 20001)
+	sig_cdf, bg_cdf = cumulative(signal_fit(grid, *po[3:]), grid), cumulative(background_fit(grid, *po[:3]), grid)
+
+	num_sig = rng.binomial(num_events, sig_cdf[-1]/(sig_cdf[-1] + bg_cdf[-1]))
+	num_bg = num_events - num_sig
+	mass_diffs = np.concatenate([np.interp(rng.random(num_sig)*sig_cdf[-1], sig_cdf, grid), np.interp(rng.random(num_bg)*bg_cdf[-1], bg_cdf, grid)])
+	times = np.concatenate([rng.exponential(tau, num_sig), rng.exponential(tau_bg, num_bg)]) + rng.normal(0, s, num_events)
+	return times, mass_diffs
+
+# the sideband weighted lifetime fit of maximum_likelyhood_exp_fit, with the same event selection and weights
+def fit_toy(times, mass_diffs, sidebands, s):
+	# maximum_likelyhood_exp_fit compares decayTime*1e-12 (in s) with fit_range, so only its lower edge cuts
+	keep = fit_range[0] <= times
+	times, mass_diffs = times[keep], mass_diffs[keep]
+	weights = sidebands.weights(mass_diffs)
+	tau, tau_err, _, _ = fit_lifetime(times, weights, s=s, verbose=False)
+	return tau, tau_err
+
+
+def run_toy(seed):
+	start = time.time()
+	study, arrays = worker['study'], worker['arrays']
+	rng = np.random.default_rng(seed)
+
+	if study['mode'] == 'bootstrap':
+		idx = rng.integers(0, len(arrays['times']), len(arrays['times']))
+		times, mass_diffs = arrays['times'][idx], arrays['mass_diffs'][idx]
+	else:
+		times, mass_diffs = generate_toy(rng, study['num_events'], study['po'], study['tau'], study['s'], study['tau_bg'])
+
+	tau, err = fit_toy(times, mass_diffs, study['sidebands'], study['s'])
+	return tau, err, time.time() - start
+
+
+def run_study(study, arrays, num_toys, tau_true, workers=None, seed=0):
+	study = dict(study, sidebands=SidebandModel(study['po'], study['width']))
+	seeds = np.random.SeedSequence(seed).spawn(num_toys)
+
+	with SharedArrays(arrays) as shared:
+		with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(shared.spec, {'study': study})) as pool:
+			results = np.array(list(pool.map(run_toy, seeds, chunksize=max(1, num_toys // 64))))
+
+	taus, errors, seconds = results.T
+	return ToyResults(taus, errors, (taus - tau_true)/errors, seconds, tau_true)
+
+
+# fits num_toys generated data sets of num_events each, with true lifetime tau (ps)
+# - po is the combined_fit parameters of the mass difference fit, width the signal range in widths as for get_sig_range
+def toy_study(num_toys, num_events, po, width, tau, s=pdf_gaussian_width, tau_bg=.2, workers=None, seed=0):
+	study = {'mode': 'generate', 'num_events': num_events, 'po': po, 'width': width, 'tau': tau, 's': s, 'tau_bg': tau_bg}
+	return run_study(study, {}, num_toys, tau, workers, seed)
+
+# fits num_toys bootstrap resamples of the events, pulls are relative to the fit to all of them
+def bootstrap_study(num_toys, times, mass_diffs, po, width, s=pdf_gaussian_width, workers=None, seed=0):
+	tau_true, _ = fit_toy(times, mass_diffs, SidebandModel(po, width), s)
+	study = {'mode': 'bootstrap', 'po': po, 'width': width, 's': s}
+	return run_study(study, {'times': times, 'mass_diffs': mass_diffs}, num_toys, tau_true, workers, seed)
+
+
+def print_summary(res: ToyResults):
+	print('toys', len(res.taus), 'mean tau', np.mean(res.taus), 'true', res.tau_true)
+	print('pull mean', np.mean(res.pulls), '+-', np.std(res.pulls)/np.sqrt(len(res.pulls)), 'pull width', np.std(res.pulls))
+	print('coverage', np.mean(np.abs(res.pulls) <= 1), 'seconds per toy', np.mean(res.seconds))
@@ -1,7 +1,14 @@
 import matplotlib as plt
 import numpy as np
 import sys
+import os
+import json
+import pickle
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as pl
+from Stages import update_code_hash, run_state
 
 # http://bkanuka.com/articles/native-latex-plots/
 
@@ -17,6 +24,13 @@ def figsize(scale, height_adj=0):
 	return fig_size
 
 is_latex = '--latex-plot' in sys.argv
+
+# every file written by savefig, so render_queued knows what each queued plot made
+saved_files = []
+
+def save_figure(path, **kwargs):
+	pl.savefig(path, **kwargs)
+	saved_files.append(path)
 if is_latex:
 	plt.use('pgf')
 	pgf_with_latex = {                      # setup matplotlib to use latex for output
@@ -60,12 +74,12 @@ if is_latex:
 		return fig, ax
 
 	def savefig(filename, directory=''):
-		pl.savefig(directory+filename+'.pgf')
-		pl.savefig(directory+filename+'.png')
+		save_figure(directory+filename+'.pgf')
+		save_figure(directory+filename+'.png')
 
 	def savefig_image(filename, directory=''):
-		pl.savefig(directory+filename+'.pgf', dpi=4000)
-		pl.savefig(directory+filename+'.png')
+		save_figure(directory+filename+'.pgf', dpi=4000)
+		save_figure(directory+filename+'.png')
 else:
 
 	default_width = 2
@@ -82,12 +96,78 @@ else:
 		return fig
 
 	def savefig(filename, directory=''):
-		pl.savefig(directory+filename+'.png')
+		save_figure(directory+filename+'.png')
 
 	def savefig_image(filename, directory=''):
 		savefig(filename, directory)
 
 
+# Deferred rendering: plot functions queued with queue_plot are run by render_queued at the end of the run,
+# across a process pool, so the analysis doesn't wait on matplotlib.
+# - a queued plot is its function and the data it draws, which must be picklable and the function importable
+# - a plot whose code, arguments and --latex-plot setting are unchanged since it was last rendered, and whose files
+#   are all still there, is skipped, the keys are kept in render-cache.json. The code is the function with the
+#   helpers and settings it uses, as for Stages.run_stage, and this module, which sets up matplotlib
+# - the manifest is shared by every script that renders into the directory, each run adds its plots to it and
+#   drops the entries of any whose files it drew over
+render_queue = []
+run_state.extend([saved_files, render_queue])
+
+def queue_plot(func, *args, **kwargs):
+	render_queue.append((func, args, kwargs))
+
+# a plot queued by a script run as __main__ has the same key as when its module is imported
+def plot_key(func, args, kwargs):
+	module = os.path.splitext(os.path.basename(inspect.getsourcefile(func)))[0]
+	h = hashlib.sha1()
+	h.update(('%s.%s %s' % (module, func.__qualname__, is_latex)).encode())
+	update_code_hash(h, func, set())
+	h.update(inspect.getsource(sys.modules[__name__]).encode())
+	h.update(pickle.dumps((args, kwargs), protocol=pickle.HIGHEST_PROTOCOL))
+	return h.hexdigest()
+
+# runs one queued plot in a worker, returns the files it wrote
+def render_plot(func, args, kwargs):
+	del saved_files[:]
+	func(*args, **kwargs)
+	pl.close('all')
+	return list(saved_files)
+
+def render_queued(workers=None, skip_unchanged=True, manifest='render-cache.json'):
+	rendered = {}
+	if os.path.exists(manifest):
+		with open(manifest) as f:
+			rendered = json.load(f)
+
+	keys = [plot_key(*p) for p in render_queue]
+	todo = [(k, p) for k, p in zip(keys, render_queue) \
+		if not (skip_unchanged and k in rendered and all(os.path.exists(f) for f in rendered[k]))]
+	print('rendering', len(todo), 'of', len(render_queue), 'plots')
+
+	# a plot that fails is reported once the others are rendered and recorded
+	failed = []
+	if todo:
+		with ProcessPoolExecutor(workers) as pool:
+			futures = [(k, p, pool.submit(render_plot, *p)) for k, p in todo]
+			for k, (func, _, _), future in futures:
+				try:
+					files = future.result()
+				except Exception as e:
+					print('plot', func.__qualname__, 'failed:', repr(e))
+					failed.append(func.__qualname__)
+					continue
+				# the files no longer show what an older entry for them drew
+				for old in [o for o, f in rendered.items() if o != k and set(f) & set(files)]:
+					del rendered[old]
+				rendered[k] = files
+
+	with open(manifest, 'w') as f:
+		json.dump(rendered, f, indent=1)
+	del render_queue[:]
+	if failed:
+		raise RuntimeError('%d of %d plots failed: %s' % (len(failed), len(todo), ', '.join(failed)))
+
+
 # # Simple plot
 # fig, ax  = newfig(0.6)
 # def ema(y, a):
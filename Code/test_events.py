@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from Background import c, m_pi, m_k
+from Events import EventTable, momentum_toSI, mass_toSI, mass_toMeV
+
+
+# EventTable against the same quantities worked out one event at a time, with plain 3-vectors
+
+def magnitude(v):
+	return np.sqrt(np.sum(v**2))
+
+def normed(v):
+	return v/magnitude(v)
+
+def dot(a, b):
+	return np.sum(a*b)
+
+def d0_mass(kp, pd, m_a, m_b):
+	energy = np.sqrt((momentum_toSI(magnitude(pd))*c)**2 + mass_toSI(m_a)**2 * c**4) + \
+		np.sqrt((momentum_toSI(magnitude(kp))*c)**2 + mass_toSI(m_b)**2 * c**4)
+	return energy, np.sqrt(energy**2 - (momentum_toSI(magnitude(kp+pd))*c)**2)/c**2
+
+def dstar_mass(daughter_energy, kp, pd, ps):
+	energy = daughter_energy + np.sqrt((momentum_toSI(magnitude(ps))*c)**2 + mass_toSI(m_pi)**2 * c**4)
+	return np.sqrt(energy**2 - (momentum_toSI(magnitude(kp+pd+ps))*c)**2)/c**2
+
+def decay_time(start, end, p, mass):
+	x, p = (end-start)*1e-3, momentum_toSI(p)
+	return np.sign(dot(x, p)) * magnitude(x) * mass / magnitude(p)
+
+def ip_log(ev, p):
+	x, p = (ev['d0Decay'] - ev['dstarDecay'])*1e-3, normed(momentum_toSI(p))
+	return np.log10(magnitude(x - dot(x, p)*p)*1e3)
+
+def event_quantities(ev):
+	kp, pd, ps = ev['kp'], ev['pd'], ev['ps']
+	q = {}
+	for ext, (m_a, m_b) in (('', (m_pi, m_k)), ('_pp', (m_pi, m_pi)), ('_kk', (m_k, m_k))):
+		energy, m_d0 = d0_mass(kp, pd, m_a, m_b)
+		m_dstar = dstar_mass(energy, kp, pd, ps)
+		q['reconstructedD0Mass' + ext], q['reconstructedDstarMass' + ext] = m_d0, m_dstar
+		q['massDiff_d0dstar' + ext] = mass_toMeV(m_dstar - m_d0)
+	q['labFrameTravel'] = magnitude(ev['dstarDecay'] - ev['d0Decay'])*1e-3
+	q['pD0'] = momentum_toSI(magnitude(kp+pd))
+	q['pD0_t'] = magnitude((kp+pd)[0:1])
+	q['pDstar_t'] = magnitude((kp+pd+ps)[0:1])
+	q['pPslow'] = magnitude(ps)
+	q['gamma'] = q['pD0']/(c*q['reconstructedD0Mass'])
+	q['decayTime'] = decay_time(ev['bDecay'], ev['d0Decay'], kp+pd, q['reconstructedD0Mass'])
+	q['dStarDecayTime'] = decay_time(ev['bDecay'], ev['dstarDecay'], kp+pd+ps, q['reconstructedDstarMass'])
+	q['d0IP_log'], q['kIP_log'], q['pIP_log'], q['psIP_log'] = [ip_log(ev, p) for p in (kp+pd, kp, pd, ps)]
+	q['s_z'] = ev['dstarDecay'][2] - ev['interaction'][2]
+	q['costheta'] = dot(normed(kp+pd), normed(ev['d0Decay'] - ev['dstarDecay']))
+	return q
+
+
+# candidates with D0s flying a few mm from a B vertex, momenta in MeV/c
+@pytest.fixture(scope='module')
+def table():
+	rng = np.random.default_rng(0)
+	n = 200
+	interaction = rng.normal(0, [.05, .05, 50], (n, 3))
+	bDecay = interaction + rng.normal([0, 0, 10], [1, 1, 5], (n, 3))
+	dstarDecay = bDecay + rng.normal(0, .05, (n, 3))
+	kp, pd = rng.normal([0, 0, 20000], [1000, 1000, 5000], (n, 3)), rng.normal([0, 0, 20000], [1000, 1000, 5000], (n, 3))
+	ps = rng.normal([0, 0, 1500], [50, 50, 300], (n, 3))
+	d0Decay = dstarDecay + normed_rows(kp+pd)*rng.exponential(5, (n, 1)) + rng.normal(0, .02, (n, 3))
+	return EventTable(interaction, dstarDecay, d0Decay, bDecay, kp, pd, ps)
+
+def normed_rows(v):
+	return v/np.sqrt(np.sum(v**2, axis=1))[:, None]
+
+
+def test_columns_match_per_event(table):
+	expected = [event_quantities({name: getattr(table, name)[i] for name in EventTable.vectors}) for i in range(len(table))]
+	for name in expected[0]:
+		np.testing.assert_allclose(getattr(table, name), [q[name] for q in expected], rtol=1e-10, err_msg=name)
+
+def test_sub_table_keeps_columns(table):
+	mask = table.decayTime > 0
+	sub = table[mask]
+	np.testing.assert_array_equal(sub.massDiff_d0dstar, table.massDiff_d0dstar[mask])
+	np.testing.assert_array_equal(sub.d0IP_log, EventTable(*[getattr(table, n)[mask] for n in EventTable.vectors]).d0IP_log)